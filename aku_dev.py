@@ -1,10 +1,88 @@
-
-import json
+import os
+import re
+import glob
+import orjson
+import shelve
+import asyncio
+import hashlib
 import itertools
+import uuid
+from collections import Counter
+from typing import Optional
+import httpx
 import requests
-
-OLLAMA_URL = "http://localhost:11434/api/generate"
-MODEL_NAME = "gemma3:4b"
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+
+# The chat endpoint lets us send CLASSIFICATION_INSTRUCTIONS as a constant
+# system message, so Ollama can reuse its KV cache across pairs.
+OLLAMA_URL = "http://localhost:11434/api/chat"
+# 4-bit quantized build of gemma3:4b (ollama pull gemma3:4b-it-q4_K_M).
+# Decoding is memory-bandwidth bound, so this roughly doubles throughput.
+# If labels drift noticeably against the full-precision model, use the
+# gemma3:4b-it-q8_0 tag instead.
+MODEL_NAME = os.environ.get("OLLAMA_MODEL", "gemma3:4b-it-q4_K_M")
+
+# Keep the model loaded between calls (and runs)
+KEEP_ALIVE = "10m"
+# The answer is a single word; don't let the model ramble.
+# vLLM constrains decoding to exactly one of LABELS, which needs room for the
+# longest label. Ollama can't constrain to a word list, but the three labels
+# start with different letters, so the first letter is enough to decide; the
+# few extra tokens leave room for leading whitespace or markdown ("**").
+# Answers that still don't decide are asked again with OLLAMA_RETRY_TOKENS.
+MAX_LABEL_TOKENS = 4
+OLLAMA_LABEL_TOKENS = 4
+OLLAMA_RETRY_TOKENS = 16
+
+# Max number of in-flight requests to Ollama. Keep this in line with the
+# OLLAMA_NUM_PARALLEL the server was started with, e.g.
+#   OLLAMA_NUM_PARALLEL=16 ollama serve
+CONCURRENCY = int(os.environ.get("OLLAMA_NUM_PARALLEL", "16"))
+
+# Which backend classifies the pairs:
+#   "ollama" - one /api/generate request per pair, sent concurrently
+#   "vllm"   - all prompts in ONE batched request to a vLLM
+#              (OpenAI-compatible) /v1/completions endpoint
+#   "vllm-engine" - vLLM's AsyncLLMEngine in this process (no HTTP at all);
+#              all prompts are submitted at once and continuously batched
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "ollama")
+VLLM_URL = os.environ.get("VLLM_URL", "http://localhost:8000/v1/completions")
+VLLM_MODEL = os.environ.get("VLLM_MODEL", "google/gemma-3-4b-it")
+# Quantization scheme for the in-process engine, e.g. "awq" together with an
+# AWQ checkpoint in VLLM_MODEL. None loads the weights as they are.
+VLLM_QUANTIZATION = os.environ.get("VLLM_QUANTIZATION")
+VLLM_GPU_MEMORY_UTILIZATION = 0.85
+# Pairs that need the LLM are queued and grouped into micro-batches of at
+# most BATCH_SIZE. A batch is sent once it is full or BATCH_TIMEOUT seconds
+# after its first pair arrived. Prompts are queued shortest-first per
+# subcategory so each batch pads as little as possible.
+BATCH_SIZE = 32
+BATCH_TIMEOUT = 0.05
+# Batches being classified at the same time
+MAX_INFLIGHT_BATCHES = 4
+
+# Pairs whose TF-IDF cosine similarity is below this share no concrete
+# vocabulary and are labelled 'bloat' without asking the LLM
+BLOAT_SIM_THRESHOLD = 0.15
+# Pairs where one (normalised) text contains the other, or whose word
+# 5-gram Jaccard similarity is above this, are labelled 'overlap' directly
+SHINGLE_SIZE = 5
+OVERLAP_JACCARD_THRESHOLD = 0.9
+
+# Persistent cache of pair classifications so re-runs skip the LLM
+CACHE_PATH = "classify_cache.db"
+
+# Seconds to wait for a single (non-streaming) LLM response
+REQUEST_TIMEOUT = 600
+
+# One pooled session for all blocking calls, so every request reuses an open
+# keep-alive connection instead of doing a fresh TCP handshake.
+_SESSION = requests.Session()
+_SESSION.headers["Content-Type"] = "application/json"
+_SESSION.mount(
+    "http://", requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32)
+)
 
 CLASSIFICATION_INSTRUCTIONS = """
 Compare Paragraph A and Paragraph B. Output one label: contradiction, overlap, or bloat.
@@ -42,49 +120,310 @@ Output: one lowercase word, nothing else.
 """
 
 
-def call_ollama(prompt: str, model: str = MODEL_NAME, temperature: float = 0.1) -> str:
-    payload = {
+# Labels in decision order, and the fallback for answers that only give
+# the first letter or similar
+LABELS = ("contradiction", "overlap", "bloat")
+_FIRST_CHAR_LABEL = {label[0]: label for label in LABELS}
+
+
+def normalise_label(raw: str) -> str:
+    """
+    Map a raw model answer to one of: 'contradiction', 'overlap', 'bloat'.
+    """
+    raw = raw.strip(" \t\n*_`'\"").lower()
+
+    for label in LABELS:
+        if label in raw:
+            return label
+    try:
+        return _FIRST_CHAR_LABEL[raw[:1]]
+    except KeyError:
+        raise ValueError(f"Model did not answer with a valid label: {raw}") from None
+
+
+def build_chat_payload(
+    prompt: str,
+    model: str = MODEL_NAME,
+    temperature: float = 0.1,
+    system: str = CLASSIFICATION_INSTRUCTIONS,
+    max_tokens: int = OLLAMA_LABEL_TOKENS,
+) -> dict:
+    return {
         "model": model,
-        "prompt": prompt,
+        "messages": [
+            {"role": "system", "content": system},
+            {"role": "user", "content": prompt},
+        ],
         "stream": False,
-        "options": {"temperature": temperature},
+        "keep_alive": KEEP_ALIVE,
+        "options": {"temperature": temperature, "num_predict": max_tokens},
     }
-    resp = requests.post(OLLAMA_URL, json=payload)
-    resp.raise_for_status()
-    raw = resp.json()["response"].strip().lower()
 
-    # Normalise to one of the three labels
-    if "contradiction" in raw:
-        return "contradiction"
-    if "overlap" in raw:
-        return "overlap"
-    if "bloat" in raw:
-        return "bloat"
 
-    # Fallbacks if it only gives first letters or similar
-    if raw.startswith("c"):
-        return "contradiction"
-    if raw.startswith("o"):
-        return "overlap"
-    if raw.startswith("b"):
-        return "bloat"
+def call_ollama(prompt: str, model: str = MODEL_NAME, temperature: float = 0.1) -> str:
+    payload = build_chat_payload(prompt, model, temperature)
+    resp = _SESSION.post(OLLAMA_URL, json=payload, timeout=REQUEST_TIMEOUT)
+    resp.raise_for_status()
+    return normalise_label(resp.json()["message"]["content"])
 
-    raise ValueError(f"Model did not answer with a valid label: {raw}")
+
+async def call_ollama_async(
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    prompt: str,
+    model: str = MODEL_NAME,
+    temperature: float = 0.1,
+    max_tokens: int = OLLAMA_LABEL_TOKENS,
+) -> str:
+    """
+    Async version of call_ollama. The semaphore caps the number of requests
+    in flight so we don't queue more work than Ollama can serve in parallel.
+    """
+    payload = build_chat_payload(prompt, model, temperature, max_tokens=max_tokens)
+    async with sem:
+        resp = await client.post(OLLAMA_URL, json=payload)
+    resp.raise_for_status()
+    return normalise_label(resp.json()["message"]["content"])
 
 
-def classify_paragraph_pair(p_a: str, p_b: str) -> str:
+def make_async_client() -> httpx.AsyncClient:
     """
-    Return one of: 'contradiction', 'overlap', 'bloat'.
+    One client for all concurrent requests. With HTTP/2 (negotiated when the
+    backend is served over TLS) every in-flight request is multiplexed over a
+    single connection; plain-HTTP servers fall back to a keep-alive pool that
+    is sized to CONCURRENCY.
     """
-    prompt = f"""{CLASSIFICATION_INSTRUCTIONS}
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=REQUEST_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=CONCURRENCY, max_keepalive_connections=CONCURRENCY
+        ),
+    )
+
 
-Paragraph A:
+def build_user_prompt(p_a: str, p_b: str) -> str:
+    """
+    The per-pair part of the prompt; the instructions go in the system message.
+    """
+    return f"""Paragraph A:
 \"\"\"{p_a}\"\"\"
 
 Paragraph B:
 \"\"\"{p_b}\"\"\"
 """
-    return call_ollama(prompt)
+
+
+def build_prompt(p_a: str, p_b: str) -> str:
+    """
+    Full single-string prompt for completion-style endpoints (vLLM).
+    """
+    return f"""{CLASSIFICATION_INSTRUCTIONS}
+
+{build_user_prompt(p_a, p_b)}"""
+
+
+def classify_paragraph_pair(p_a: str, p_b: str) -> str:
+    """
+    Return one of: 'contradiction', 'overlap', 'bloat'.
+    """
+    if p_a == p_b:
+        return "overlap"
+    return call_ollama(build_user_prompt(p_a, p_b))
+
+
+async def classify_paragraph_pair_async(
+    client: httpx.AsyncClient, sem: asyncio.Semaphore, p_a: str, p_b: str
+) -> Optional[str]:
+    """
+    Return one of: 'contradiction', 'overlap', 'bloat', or None if the model
+    gave no valid label even with OLLAMA_RETRY_TOKENS to answer in.
+    """
+    prompt = build_user_prompt(p_a, p_b)
+    try:
+        return await call_ollama_async(client, sem, prompt)
+    except ValueError:
+        pass
+    try:
+        return await call_ollama_async(
+            client, sem, prompt, max_tokens=OLLAMA_RETRY_TOKENS
+        )
+    except ValueError as e:
+        print(f"{e}; the pair is left for the next run")
+        return None
+
+
+async def batch_classify(
+    client: httpx.AsyncClient,
+    prompts: list,
+    model: str = VLLM_MODEL,
+    temperature: float = 0.1,
+) -> list:
+    """
+    Send all prompts to vLLM in a single /v1/completions request so the
+    server can run them as one batch. Decoding is constrained to LABELS, so
+    every answer is a valid label after at most a few tokens.
+    """
+    if not prompts:
+        return []
+    payload = {
+        "model": model,
+        "prompt": prompts,
+        "max_tokens": MAX_LABEL_TOKENS,
+        # only allow the model to emit one of the labels
+        "guided_choice": list(LABELS),
+        "temperature": temperature,
+    }
+    resp = await client.post(VLLM_URL, json=payload)
+    resp.raise_for_status()
+    # choices are not guaranteed to come back in order, use their index
+    choices = sorted(resp.json()["choices"], key=lambda c: c["index"])
+    return [normalise_label(c["text"]) for c in choices]
+
+
+# In-process vLLM engine and the event loop it runs on. The engine's
+# background loop is tied to one event loop, so we keep reusing the same one
+# instead of asyncio.run() per call.
+_ENGINE = None
+_ENGINE_LOOP = None
+
+
+def get_engine():
+    """
+    Lazily start vLLM's AsyncLLMEngine (only needed for LLM_BACKEND=vllm-engine).
+    """
+    global _ENGINE, _ENGINE_LOOP
+    if _ENGINE is None:
+        from vllm import AsyncEngineArgs, AsyncLLMEngine
+
+        _ENGINE_LOOP = asyncio.new_event_loop()
+        _ENGINE = AsyncLLMEngine.from_engine_args(
+            AsyncEngineArgs(
+                model=VLLM_MODEL,
+                quantization=VLLM_QUANTIZATION,
+                gpu_memory_utilization=VLLM_GPU_MEMORY_UTILIZATION,
+            )
+        )
+    return _ENGINE
+
+
+async def generate_with_engine(engine, prompt: str, sampling_params) -> str:
+    final = None
+    async for output in engine.generate(
+        prompt, sampling_params, request_id=uuid.uuid4().hex
+    ):
+        final = output
+    return normalise_label(final.outputs[0].text)
+
+
+async def classify_pairs_engine(engine, pairs: list, temperature: float = 0.1) -> list:
+    """
+    Submit every pair to the in-process engine at once; vLLM schedules them
+    with continuous batching. Results are in the same order as `pairs`.
+    """
+    from vllm import SamplingParams
+    from vllm.sampling_params import GuidedDecodingParams
+
+    params = SamplingParams(
+        temperature=temperature,
+        max_tokens=MAX_LABEL_TOKENS,
+        guided_decoding=GuidedDecodingParams(choice=list(LABELS)),
+    )
+    return await asyncio.gather(
+        *[generate_with_engine(engine, build_prompt(a, b), params) for a, b in pairs]
+    )
+
+
+async def classify_batch_async(
+    client: httpx.AsyncClient, sem: asyncio.Semaphore, pairs: list
+) -> list:
+    """
+    Classify one micro-batch of (text_a, text_b) pairs with the configured
+    LLM_BACKEND. Results are returned in the same order as `pairs`.
+    """
+    if LLM_BACKEND == "vllm":
+        prompts = [build_prompt(a, b) for a, b in pairs]
+        return await batch_classify(client, prompts)
+    if LLM_BACKEND == "vllm-engine":
+        return await classify_pairs_engine(get_engine(), pairs)
+    return await asyncio.gather(
+        *[classify_paragraph_pair_async(client, sem, a, b) for a, b in pairs]
+    )
+
+
+def run_async(coro):
+    """
+    Run a coroutine to completion. The in-process vLLM engine is bound to the
+    loop it was started on, so for that backend we always reuse _ENGINE_LOOP.
+    """
+    if LLM_BACKEND == "vllm-engine":
+        get_engine()
+        return _ENGINE_LOOP.run_until_complete(coro)
+    return asyncio.run(coro)
+
+
+def text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def pair_key(hash_a: str, hash_b: str) -> str:
+    """
+    Cache key of a pair from the text_hash of both texts. The relation is
+    symmetric, so (A, B) and (B, A) map to the same key.
+    """
+    return "|".join(sorted((hash_a, hash_b)))
+
+
+def tfidf_similarity_matrix(texts: list):
+    """
+    Dense k x k TF-IDF cosine similarity matrix for the given texts.
+    """
+    try:
+        tfidf_matrix = TfidfVectorizer(stop_words="english").fit_transform(texts)
+    except ValueError:
+        # empty vocabulary: nothing in common at all
+        return [[0.0] * len(texts) for _ in texts]
+    return cosine_similarity(tfidf_matrix)
+
+
+def normalise_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text.lower().strip())
+
+
+def shingles(norm_text: str, size: int = SHINGLE_SIZE) -> frozenset:
+    """
+    Set of word `size`-grams of an already normalised text.
+    """
+    words = norm_text.split(" ")
+    return frozenset(
+        tuple(words[k:k + size]) for k in range(len(words) - size + 1)
+    )
+
+
+def pre_classify(
+    norm_a: str,
+    norm_b: str,
+    shingles_a: frozenset,
+    shingles_b: frozenset,
+    sim: float,
+    bloat_threshold: float = BLOAT_SIM_THRESHOLD,
+):
+    """
+    Label the obvious pairs without the LLM:
+    - one text contained in the other, or near-identical 5-grams -> 'overlap'
+    - TF-IDF cosine similarity `sim` below bloat_threshold -> 'bloat'
+    Returns None when the LLM has to decide.
+    """
+    if norm_a in norm_b or norm_b in norm_a:
+        return "overlap"
+    if shingles_a and shingles_b:
+        common = len(shingles_a & shingles_b)
+        jaccard = common / (len(shingles_a) + len(shingles_b) - common)
+        if jaccard > OVERLAP_JACCARD_THRESHOLD:
+            return "overlap"
+    if sim < bloat_threshold:
+        return "bloat"
+    return None
 
 
 def summarize_relations(results: list) -> dict:
@@ -94,11 +433,10 @@ def summarize_relations(results: list) -> dict:
     Metrics 'overlap' and 'contradiction' EXCLUDE bloat from the 'total_metric'
     so you can evaluate only on substantive pairs.
     """
-    counts = {"overlap": 0, "contradiction": 0, "bloat": 0}
-    for r in results:
-        rel = r.get("relation")
-        if rel in counts:
-            counts[rel] += 1
+    relation_counts = Counter(r.get("relation") for r in results)
+    counts = {
+        label: relation_counts[label] for label in ("overlap", "contradiction", "bloat")
+    }
 
     # Total number of pairs used for core metrics (exclude bloat)
     counts["total_metric"] = counts["overlap"] + counts["contradiction"]
@@ -107,9 +445,353 @@ def summarize_relations(results: list) -> dict:
     return counts
 
 
+def texts_path_for(output_path: str) -> str:
+    """
+    Sidecar file that stores the full article texts, keyed by text_hash.
+    """
+    return os.path.splitext(output_path)[0] + "_texts.json"
+
+
+def article_text(entry: dict) -> str:
+    """
+    Full text of a clustered article entry (all paragraphs concatenated).
+    """
+    art = entry.get("article", {})
+    return "\n\n".join(art.get("article paragraphs", []) or [])
+
+
+def save_texts(texts_path: str, data: list, texts_by_hash: dict) -> None:
+    """
+    Add the text of every (non-empty) article in `data` to `texts_by_hash`
+    and write it to the sidecar, so each record's hashes resolve even if the
+    run dies before it is done.
+    """
+    for subcat in data:
+        for entry in subcat.get("articles", []):
+            text = article_text(entry)
+            if text:
+                texts_by_hash[text_hash(text)] = text
+    tmp_path = texts_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(texts_by_hash, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_path, texts_path)
+
+
+def load_relations(output_path: str) -> list:
+    """
+    Read the relation records already written to a JSONL output file.
+    A truncated last line (e.g. after a crash) is ignored.
+    """
+    records = []
+    if not os.path.exists(output_path):
+        return records
+    with open(output_path, "rb") as f:
+        for line in f:
+            try:
+                records.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                continue
+    return records
+
+
+def _ends_with_newline(path: str) -> bool:
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def _relation_key(
+    subcat_label: str, id_a: str, id_b: str, hash_a: str, hash_b: str
+) -> tuple:
+    # Articles with the same text still get a record per article pair, so
+    # the ids are part of the key
+    return (subcat_label, id_a, id_b, hash_a, hash_b)
+
+
+async def _next_batch(queue: asyncio.Queue, max_size: int, timeout: float):
+    """
+    Take up to `max_size` items from `queue`, waiting at most `timeout`
+    seconds after the first one. Returns (batch, finished) where `finished`
+    means the producer's None sentinel was reached.
+    """
+    item = await queue.get()
+    if item is None:
+        return [], True
+    batch = [item]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while len(batch) < max_size:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            item = await asyncio.wait_for(queue.get(), remaining)
+        except asyncio.TimeoutError:
+            break
+        if item is None:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+
+async def run_pipeline(
+    data: list,
+    out,
+    cache,
+    done: set,
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    bloat_threshold: float = BLOAT_SIM_THRESHOLD,
+    name: str = "",
+) -> list:
+    """
+    Classify all article pairs of a clustered file with three coroutines:
+
+    - producer: walks the subcategories and their article pairs, settles
+      everything it can without the LLM (already done, pre_classify, cache
+      hits) and queues the rest as LLM requests.
+    - server: drains the request queue into micro-batches and classifies
+      them while it keeps collecting the next batch.
+    - writer: streams finished records to `out` and stores fresh LLM
+      labels in `cache`.
+
+    `client` and `sem` can be shared by several pipelines running at the
+    same time, so CONCURRENCY holds across all of them.
+
+    Returns the newly written records.
+    """
+    # Labels from different models (e.g. quantized vs full precision) must
+    # not be mixed, so cache entries are scoped by model
+    model = MODEL_NAME if LLM_BACKEND == "ollama" else VLLM_MODEL
+
+    # producer -> server: (cache key, text_a, text_b), None when done
+    request_q = asyncio.Queue(maxsize=4 * BATCH_SIZE)
+    # producer/server -> writer: (cache key or None, relation, records)
+    result_q = asyncio.Queue(maxsize=4 * BATCH_SIZE)
+    # cache key -> records waiting for that pair's label, so duplicate
+    # pairs within one run are only sent to the LLM once
+    waiting = {}
+    new_results = []
+    stats = {
+        "pre-filtered as overlap": 0,
+        "pre-filtered as bloat": 0,
+        "from cache": 0,
+        "sent to the LLM": 0,
+        "without a valid label": 0,
+    }
+
+    async def producer():
+        for subcat in data:
+            print("start new subcat")
+            subcat_label = subcat.get("reference_label", "UNKNOWN_SUBCATEGORY")
+            articles = subcat.get("articles", [])
+
+            # Build id, text and hash once per article instead of once per pair
+            arts = []
+            for k, entry in enumerate(articles):
+                art = entry.get("article", {})
+                # Compare full article texts (concatenate all paragraphs)
+                text = article_text(entry)
+                arts.append(
+                    (art.get("article id", f"article_{k}"), text,
+                     text_hash(text) if text else None)
+                )
+
+            # Cheap lexical similarity between all articles of this subcategory
+            sims = tfidf_similarity_matrix([text for _, text, _ in arts])
+            norms = [normalise_text(text) for _, text, _ in arts]
+            shingle_sets = [shingles(norm) for norm in norms]
+
+            # Skip empty articles
+            nonempty = [k for k, (_, text, _) in enumerate(arts) if text]
+
+            llm_requests = []
+
+            # All pairs of DIFFERENT articles: i != j
+            for i, j in itertools.combinations(nonempty, 2):
+                art_a_id, text_a, hash_a = arts[i]
+                art_b_id, text_b, hash_b = arts[j]
+
+                if _relation_key(
+                    subcat_label, art_a_id, art_b_id, hash_a, hash_b
+                ) in done:
+                    continue
+
+                record = {
+                    "subcategory": subcat_label,
+                    "section_a_id": art_a_id,
+                    "section_b_id": art_b_id,
+                    # Full article texts are in the _texts.json sidecar
+                    "text_a_hash": hash_a,
+                    "text_b_hash": hash_b,
+                    "relation": None,  # 'overlap', 'contradiction', or 'bloat'
+                }
+
+                # Contained / near-identical texts and low lexical similarity
+                relation = pre_classify(
+                    norms[i], norms[j], shingle_sets[i], shingle_sets[j],
+                    sims[i][j], bloat_threshold,
+                )
+                if relation is not None:
+                    stats[f"pre-filtered as {relation}"] += 1
+                    await result_q.put((None, relation, [record]))
+                    continue
+
+                key = f"{model}:{pair_key(hash_a, hash_b)}"
+                if key in waiting:
+                    waiting[key].append(record)
+                elif key in cache:
+                    stats["from cache"] += 1
+                    await result_q.put((None, cache[key], [record]))
+                else:
+                    waiting[key] = [record]
+                    llm_requests.append((key, text_a, text_b))
+
+            # shortest prompts first, so each micro-batch has similar lengths
+            llm_requests.sort(key=lambda r: len(r[1]) + len(r[2]))
+            stats["sent to the LLM"] += len(llm_requests)
+            for request in llm_requests:
+                await request_q.put(request)
+
+        await request_q.put(None)
+
+    async def serve_batch(batch, slots):
+        try:
+            relations = await classify_batch_async(
+                client, sem, [(a, b) for _, a, b in batch]
+            )
+        finally:
+            slots.release()
+        for (key, _, _), relation in zip(batch, relations):
+            await result_q.put((key, relation, None))
+
+    async def server():
+        slots = asyncio.Semaphore(MAX_INFLIGHT_BATCHES)
+        tasks = set()
+        finished = False
+        while not finished:
+            batch, finished = await _next_batch(request_q, BATCH_SIZE, BATCH_TIMEOUT)
+            if not batch:
+                continue
+            await slots.acquire()
+            tasks.add(asyncio.create_task(serve_batch(batch, slots)))
+            # drop finished batches as we go, but re-raise a failed one now
+            for task in [t for t in tasks if t.done()]:
+                tasks.discard(task)
+                task.result()
+        # gather() re-raises the first failed batch
+        await asyncio.gather(*tasks)
+        await result_q.put(None)
+
+    async def writer():
+        while True:
+            item = await result_q.get()
+            if item is None:
+                break
+            key, relation, records = item
+            if key is not None:
+                # fresh LLM label: resolve every record waiting for it
+                records = waiting.pop(key)
+                if relation is None:
+                    # neither cached nor written, so a resumed run asks again
+                    stats["without a valid label"] += len(records)
+                    continue
+                cache[key] = relation
+            for record in records:
+                record["relation"] = relation
+                out.write(orjson.dumps(record) + b"\n")
+            new_results.extend(records)
+            if result_q.empty():
+                out.flush()
+
+    await asyncio.gather(producer(), server(), writer())
+
+    print(f"{name}: " + ", ".join(f"{n} pairs {what}" for what, n in stats.items()))
+    return new_results
+
+
+async def analyse_clustered_file_async(
+    json_path: str,
+    output_path: str,
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    cache,
+    bloat_threshold: float = BLOAT_SIM_THRESHOLD,
+) -> list:
+    """
+    Async core of analyse_clustered_file; see there for the formats.
+    """
+    with open(json_path, "rb") as f:
+        data = orjson.loads(f.read())
+
+    texts_path = texts_path_for(output_path)
+    texts_by_hash = {}
+    if os.path.exists(texts_path):
+        with open(texts_path, "rb") as f:
+            texts_by_hash = orjson.loads(f.read())
+
+    all_results = load_relations(output_path)
+    done = {
+        _relation_key(
+            r["subcategory"], r["section_a_id"], r["section_b_id"],
+            r["text_a_hash"], r["text_b_hash"],
+        )
+        for r in all_results
+    }
+    if done:
+        print(f"Resuming: {len(done)} pairs already in {output_path}")
+
+    # the sidecar goes first, records are only appended after it
+    save_texts(texts_path, data, texts_by_hash)
+
+    with open(output_path, "ab") as out:
+        # start on a fresh line if the previous run died mid-record
+        if out.tell() and not _ends_with_newline(output_path):
+            out.write(b"\n")
+
+        all_results.extend(await run_pipeline(
+            data, out, cache, done, client, sem,
+            bloat_threshold, name=json_path,
+        ))
+
+    return all_results
+
+
+async def _analyse_files(jobs: list, bloat_threshold: float, cache_path: str) -> list:
+    sem = asyncio.Semaphore(CONCURRENCY)
+    with shelve.open(cache_path) as cache:
+        async with make_async_client() as client:
+            return await asyncio.gather(*[
+                analyse_clustered_file_async(
+                    json_path, output_path, client, sem, cache, bloat_threshold
+                )
+                for json_path, output_path in jobs
+            ])
+
+
+def analyse_clustered_files(
+    jobs: list,
+    bloat_threshold: float = BLOAT_SIM_THRESHOLD,
+    cache_path: str = CACHE_PATH,
+) -> list:
+    """
+    Analyse several clustered files at the same time.
+
+    jobs: list of (json_path, output_path) tuples.
+    Returns one list of relation records per job, in the same order.
+
+    All files feed the same LLM backend (one HTTP client, one CONCURRENCY
+    limit, one cache), so pairs from different files get batched together
+    instead of each file waiting for the previous one.
+    """
+    return run_async(_analyse_files(jobs, bloat_threshold, cache_path))
+
+
 def analyse_clustered_file(
     json_path: str,
-    output_path: str = "relations_output.json"
+    output_path: str = "relations_output.jsonl",
+    bloat_threshold: float = BLOAT_SIM_THRESHOLD,
+    cache_path: str = CACHE_PATH,
 ) -> list:
     """
     Run analysis on a single clustered file with structure like
@@ -136,74 +818,52 @@ def analyse_clustered_file(
     - Within each subcategory, each entry in "articles" is an article.
     - We compare WHOLE articles (all paragraphs concatenated) ONLY
       between different articles within the same subcategory.
+    - Pairs with TF-IDF cosine similarity below `bloat_threshold` are
+      labelled 'bloat', and pairs where one article contains the other (or
+      near-identical texts) 'overlap', without ever reaching the LLM.
+    - The remaining pairs are classified in micro-batches (see run_pipeline):
+      concurrently against Ollama (at most CONCURRENCY requests in flight),
+      as batched requests to vLLM (LLM_BACKEND=vllm) or through an
+      in-process vLLM engine (LLM_BACKEND=vllm-engine).
+
+    Output:
+    - `output_path` is JSONL, one relation record per line, written as soon
+      as the pair is classified. Records only reference the article texts by
+      hash; the texts themselves are written once to `<output>_texts.json`.
+    - If `output_path` already exists the run resumes: pairs already in the
+      file are skipped.
     """
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    all_results = []
-
-    for subcat in data:
-        print("start new subcat")
-        subcat_label = subcat.get("reference_label", "UNKNOWN_SUBCATEGORY")
-        articles = subcat.get("articles", [])
-
-        # All pairs of DIFFERENT articles: i != j
-        for i, j in itertools.combinations(range(len(articles)), 2):
-            art_a = articles[i].get("article", {})
-            art_b = articles[j].get("article", {})
-
-            art_a_id = art_a.get("article id", f"article_{i}")
-            art_b_id = art_b.get("article id", f"article_{j}")
-
-            paras_a = art_a.get("article paragraphs", []) or []
-            paras_b = art_b.get("article paragraphs", []) or []
-
-            # Skip empty articles
-            if not paras_a or not paras_b:
-                continue
-
-            # Compare full article texts (concatenate all paragraphs)
-            text_a = "\n\n".join(paras_a)
-            text_b = "\n\n".join(paras_b)
+    return analyse_clustered_files(
+        [(json_path, output_path)], bloat_threshold, cache_path
+    )[0]
 
-            relation = classify_paragraph_pair(text_a, text_b)
 
-            all_results.append(
-                {
-                    "subcategory": subcat_label,
-                    "section_a_id": art_a_id,
-                    "section_b_id": art_b_id,
-                    # Indices are not meaningful at article level; set to None
-                    "paragraph_a_index": None,
-                    "paragraph_b_index": None,
-                    # These now contain the FULL article texts
-                    "paragraph_a_text": text_a,
-                    "paragraph_b_text": text_b,
-                    "relation": relation,  # 'overlap', 'contradiction', or 'bloat'
-                }
-            )
-
-    # save all article-level relations
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(all_results, f, indent=2, ensure_ascii=False)
-
-    return all_results
+def relations_output_path(json_path: str) -> str:
+    """
+    e.g. clustered_data/market_risk_clustered.json -> relations_output_market_risk.jsonl
+    """
+    name, _ = os.path.splitext(os.path.basename(json_path))
+    return f"relations_output_{name.replace('_clustered', '')}.jsonl"
 
 
 if __name__ == "__main__":
-    # Example usage with your file:
-    results = analyse_clustered_file(
-        "clustered_data/compliance_risk_clustered_old.json"
+    # Analyse every clustered risk file at once against the same backend
+    files = sorted(glob.glob("clustered_data/*_clustered.json"))
+    all_file_results = analyse_clustered_files(
+        [(path, relations_output_path(path)) for path in files]
     )
-    summary = summarize_relations(results)
-
-    print(len(results), "article pairs analysed (including bloat)")
-    print("Overlaps (used in metrics):", summary["overlap"])
-    print("Contradictions (used in metrics):", summary["contradiction"])
-    print("Bloat (ignored in metrics):", summary["bloat"])
-    print("Total used for metrics (overlap + contradiction):",
-          summary["total_metric"])
-    print("Total pairs including bloat:", summary["total_all"])
+
+    for path, results in zip(files, all_file_results):
+        summary = summarize_relations(results)
+
+        print(f"\n{path}:")
+        print(len(results), "article pairs analysed (including bloat)")
+        print("Overlaps (used in metrics):", summary["overlap"])
+        print("Contradictions (used in metrics):", summary["contradiction"])
+        print("Bloat (ignored in metrics):", summary["bloat"])
+        print("Total used for metrics (overlap + contradiction):",
+              summary["total_metric"])
+        print("Total pairs including bloat:", summary["total_all"])
 
 
 # import json
@@ -0,0 +1,18 @@
+"""
+Reading the article files the pipeline steps pass to each other, shared by
+split_by_risk_category.py and binitys.py.
+"""
+import orjson
+from typing import List, Dict, Any
+
+
+def load_articles(path: str) -> List[Dict[str, Any]]:
+    """
+    Reads a step's article output: JSONL (one article per line) as written
+    by select_relevant and split_by_risk_category, or an older plain JSON
+    list.
+    """
+    with open(path, "rb") as f:
+        if not path.endswith(".jsonl"):
+            return orjson.loads(f.read())
+        return [orjson.loads(line) for line in f if line.strip()]
@@ -1,43 +1,136 @@
-import json
-import subprocess
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import os
+import re
+import orjson
+import shelve
+import asyncio
+import hashlib
+import logging
+import httpx
+import numpy as np
+import requests
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+
+from article_io import load_articles
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_URL = "http://localhost:11434/api/generate"
+# Keep the model loaded in the Ollama daemon between calls
+KEEP_ALIVE = "30m"
+# The answer is a single number like "0.85". Ollama constrains decoding to
+# SCORE_FORMAT, so the model can't answer with prose.
+MAX_SCORE_TOKENS = 6
+SCORE_FORMAT = {"type": "number", "minimum": 0, "maximum": 1}
+# Prefill time grows with the prompt, so long articles are cut down to
+# their first PROMPT_HEAD_WORDS and last PROMPT_TAIL_WORDS words.
+PROMPT_HEAD_WORDS = 400
+PROMPT_TAIL_WORDS = 200
+
+# Max number of comparisons in flight at once. Keep this in line with the
+# OLLAMA_NUM_PARALLEL the server was started with, so Ollama can batch them.
+CONCURRENCY = int(os.environ.get("OLLAMA_NUM_PARALLEL", "16"))
+REQUEST_TIMEOUT = 600
+# Number of upcoming articles whose comparisons are started ahead of the
+# one being clustered, to keep the server busy between decisions
+LOOKAHEAD = 8
+
+# How candidate references are pre-selected before the LLM:
+#   "tfidf" - earlier articles with TF-IDF cosine >= tfidf_threshold
+#   "bm25"  - the BM25_TOP_K most similar articles by BM25 (bm25s package),
+#             restricted to earlier ones; tfidf_threshold is not used
+CANDIDATE_RETRIEVER = os.environ.get("CANDIDATE_RETRIEVER", "tfidf")
+BM25_TOP_K = 50
+# TF-IDF similarities are computed for at most this many references at a
+# time, to bound the working set on large corpora
+SIM_BLOCK_SIZE = 4096
+# Hashed TF-IDF dimensions; collisions are negligible at this size
+HASH_FEATURES = 2**18
+
+# Optional bi-encoder re-rank (embedding_band in cluster_articles_with_tfidf):
+# every article is embedded once with a small sentence-embedding model
+# (ollama pull all-minilm, i.e. all-MiniLM-L6-v2). Candidates whose
+# embedding cosine is below the band are treated as unrelated, those above
+# it as matches, and only the ones inside the band go to the LLM.
+EMBED_URL = "http://localhost:11434/api/embed"
+EMBED_MODEL = "all-minilm"
+EMBED_BATCH_SIZE = 64
+# 4-bit quantized build of gemma3:1b (ollama pull gemma3:1b-it-q4_K_M).
+# The answer is a single number, so the precision loss doesn't matter and
+# decoding gets roughly twice as fast.
+SCORE_MODEL = "gemma3:1b-it-q4_K_M"
+
+# Persistent cache of LLM scores, so re-runs with other thresholds skip
+# every comparison that was already made
+SCORE_CACHE_PATH = "score_cache.db"
+# Clustering decisions, one JSON line per article, used to resume a run
+CLUSTER_LOG_PATH = "clusters.jsonl"
+
+# One session for all calls so they reuse the same keep-alive connection
+SESSION = requests.Session()
 
 
 # -----------------------------
 # LLM CALL (Gemma 3:4 via Ollama)
 # -----------------------------
-def call_ollama(prompt, model="gemma3:1b"):
-    result = subprocess.run(
-        ["ollama", "run", model],
-        input=prompt.encode("utf-8"),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+def call_ollama(prompt, model=SCORE_MODEL):
+    r = SESSION.post(
+        OLLAMA_URL, json=build_score_payload(prompt, model), timeout=REQUEST_TIMEOUT
     )
-    return result.stdout.decode("utf-8").strip()
+    r.raise_for_status()
+    return r.json()["response"].strip()
+
+
+def build_score_payload(prompt, model):
+    return {
+        "model": model,
+        "prompt": prompt,
+        "stream": False,
+        "keep_alive": KEEP_ALIVE,
+        "format": SCORE_FORMAT,
+        "options": {"num_predict": MAX_SCORE_TOKENS, "temperature": 0},
+    }
+
+
+async def call_ollama_async(client, sem, prompt, model=SCORE_MODEL):
+    async with sem:
+        r = await client.post(OLLAMA_URL, json=build_score_payload(prompt, model))
+    r.raise_for_status()
+    return r.json()["response"].strip()
 
 
 # -----------------------------
 # Convert article dict to text
 # -----------------------------
 def build_article_text(article):
-    text = f"{article.get('document name', '')}\n"
-    text += f"{article.get('article id', '')}\n"
-    text += f"{article.get('article name', '')}\n"
-    for p in article.get("article paragraphs", []):
-        text += f"{p}\n"
-    return text
+    parts = [
+        article.get("document name", ""),
+        article.get("article id", ""),
+        article.get("article name", ""),
+    ]
+    parts.extend(article.get("article paragraphs", []))
+    parts.append("")  # keep the trailing newline
+    return "\n".join(map(str, parts))
+
+
+_WORD_RE = re.compile(r"\S+")
+
+
+def truncate_text(text, head=PROMPT_HEAD_WORDS, tail=PROMPT_TAIL_WORDS):
+    """
+    Keep the first `head` and last `tail` words of text, joined by "...".
+    Words are whitespace-separated runs, a tokenizer-free approximation of
+    model tokens; line breaks inside the kept parts are preserved.
+    """
+    spans = [m.span() for m in _WORD_RE.finditer(text)]
+    if len(spans) <= head + tail:
+        return text
+    return f"{text[:spans[head - 1][1]]}\n...\n{text[spans[-tail][0]:]}"
 
 
 # -----------------------------
 # Compute LLM similarity score
 # -----------------------------
-def compare_articles_score(article_a, article_b):
-    text_a = build_article_text(article_a)
-    text_b = build_article_text(article_b)
-
-    prompt = f"""
-    You are a compliance analyst AI for financial regulation. Compare the following two regulatory articles.
+SCORE_PROMPT_PREFIX = """You are a compliance analyst AI for financial regulation. Compare the following two regulatory articles.
 
     Output a single decimal number between 0 and 1 representing their similarity:
     - 1.0 = the articles contain overlapping or contradictory requirements/obligations
@@ -46,15 +139,33 @@ def compare_articles_score(article_a, article_b):
     - Round to two decimal places
 
     Article A:
-    {text_a}
+    """
+SCORE_PROMPT_MIDDLE = """
 
     Article B:
-    {text_b}
+    """
+SCORE_PROMPT_SUFFIX = """
+
+    Answer with only the number:"""
+
+
+def build_score_prompt(text_a, text_b):
+    # Only the two texts vary, so the static instructions come first and are
+    # identical across calls (Ollama reuses their KV cache)
+    return "".join(
+        (
+            SCORE_PROMPT_PREFIX,
+            truncate_text(text_a),
+            SCORE_PROMPT_MIDDLE,
+            truncate_text(text_b),
+            SCORE_PROMPT_SUFFIX,
+        )
+    )
 
-    Answer with only the number:
-    """.strip()
 
-    response = call_ollama(prompt)
+def parse_score(response):
+    # The format already rules out prose; this only guards against an
+    # answer cut off by num_predict or a model ignoring the bounds
     try:
         score = float(response.strip())
         score = max(0.0, min(1.0, score))
@@ -63,114 +174,519 @@ def compare_articles_score(article_a, article_b):
     return score
 
 
+def text_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+# Scores depend on the prompt the texts are put in, including how they are
+# truncated, so editing either starts a fresh set of cache entries
+SCORE_PROMPT_VERSION = text_hash(
+    "|".join(
+        (SCORE_PROMPT_PREFIX, SCORE_PROMPT_MIDDLE, SCORE_PROMPT_SUFFIX,
+         str(PROMPT_HEAD_WORDS), str(PROMPT_TAIL_WORDS))
+    )
+)[:8]
+
+
+def score_cache_key(text_a, text_b, model=SCORE_MODEL):
+    """
+    The score is symmetric, so (A, B) and (B, A) share one key. Scores of
+    different models and prompt versions are kept apart.
+    """
+    return f"{model}:{SCORE_PROMPT_VERSION}:" + "|".join(
+        sorted((text_hash(text_a), text_hash(text_b)))
+    )
+
+
+def compare_articles_score(text_a, text_b, cache=None):
+    """
+    LLM similarity of two article texts (see build_article_text), or -1.0
+    if the answer could not be parsed.
+    """
+    key = score_cache_key(text_a, text_b)
+    if cache is not None and key in cache:
+        return cache[key]
+
+    score = parse_score(call_ollama(build_score_prompt(text_a, text_b)))
+    # unparsable answers (-1.0) are not cached so a re-run retries them
+    if cache is not None and score >= 0.0:
+        cache[key] = score
+    return score
+
+
+async def compare_articles_score_async(client, sem, cache, text_a, text_b):
+    key = score_cache_key(text_a, text_b)
+    if key in cache:
+        return cache[key]
+
+    prompt = build_score_prompt(text_a, text_b)
+    score = parse_score(await call_ollama_async(client, sem, prompt))
+    if score >= 0.0:
+        cache[key] = score
+    return score
+
+
+async def embed_texts(client, texts, model=EMBED_MODEL):
+    """
+    L2-normalised embeddings of texts as a (len(texts), dim) array, sent to
+    Ollama in batches of EMBED_BATCH_SIZE.
+    """
+    vectors = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        r = await client.post(
+            EMBED_URL,
+            json={
+                "model": model,
+                "input": texts[start : start + EMBED_BATCH_SIZE],
+                "keep_alive": KEEP_ALIVE,
+            },
+        )
+        r.raise_for_status()
+        vectors.extend(r.json()["embeddings"])
+    embeddings = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def embedding_verdicts(embeddings, idx, candidate_refs, band):
+    """
+    {ref_idx: score} for the candidates the embeddings are sure about:
+    1.0 if their cosine with article idx is above band, 0.0 if below it.
+    Candidates inside the band are left out and need the LLM.
+    """
+    low, high = band
+    cos = embeddings[candidate_refs] @ embeddings[idx]
+    return {
+        ref_idx: 1.0 if c >= high else 0.0
+        for ref_idx, c in zip(candidate_refs, cos.tolist())
+        if c <= low or c >= high
+    }
+
+
+async def _score_reference(client, sem, cache, corpus, idx, ref_idx, known):
+    if ref_idx in known:
+        return ref_idx, known[ref_idx]
+    score = await compare_articles_score_async(
+        client, sem, cache, corpus[idx], corpus[ref_idx]
+    )
+    return ref_idx, score
+
+
+def start_comparisons(client, sem, cache, corpus, idx, candidate_refs, known=None):
+    """
+    Start scoring article idx against each candidate reference, reusing
+    the texts in corpus. Returns the tasks, each resolving to
+    (ref_idx, score); the semaphore keeps at most CONCURRENCY of them in
+    flight, so Ollama can batch them. References in known
+    ({ref_idx: score}) resolve to that score without asking the LLM.
+    """
+    known = known or {}
+    return [
+        asyncio.create_task(
+            _score_reference(client, sem, cache, corpus, idx, ref_idx, known)
+        )
+        for ref_idx in candidate_refs
+    ]
+
+
+async def collect_scores(tasks, early_exit):
+    """
+    Wait for the comparisons started by start_comparisons. Returns
+    {ref_idx: score} for the ones that finished; once one reaches
+    early_exit the rest are cancelled.
+    """
+    scores = {}
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            ref_idx, score = await next_done
+            scores[ref_idx] = score
+            if score >= early_exit:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+    return scores
+
+
+def encode_documents(articles):
+    """
+    A small integer id per distinct document name, one per article, so the
+    hot same-document checks compare ints instead of strings.
+    """
+    ids = {}
+    return [ids.setdefault(a.get("document name"), len(ids)) for a in articles]
+
+
+def article_label(article):
+    return f"{article.get('document name', '')} {article.get('article id', '')}"
+
+
+def build_postings_by_doc(tfidf_matrix, doc_ids, block_size=SIM_BLOCK_SIZE):
+    """
+    Bucket the TF-IDF rows by document (see encode_documents):
+    {doc_id: [(rows, postings), ...]}, one entry per block of at most
+    block_size articles. rows are the article indices of the block
+    (ascending) and postings their sub-matrix as CSC. The CSC columns are
+    an inverted index: for each term, the articles containing it and their
+    weights.
+    """
+    rows_by_doc = {}
+    for i, doc_id in enumerate(doc_ids):
+        rows_by_doc.setdefault(doc_id, []).append(i)
+    return {
+        doc_id: [
+            (np.array(block), tfidf_matrix[block].tocsc())
+            for block in (
+                rows[start : start + block_size]
+                for start in range(0, len(rows), block_size)
+            )
+        ]
+        for doc_id, rows in rows_by_doc.items()
+    }
+
+
+def tfidf_candidates(tfidf_matrix, postings_by_doc, doc_ids, idx, tfidf_threshold):
+    """
+    Indices of the references worth comparing article idx with: earlier
+    articles from other documents whose TF-IDF cosine similarity reaches
+    tfidf_threshold. tfidf_matrix must be CSR with L2-normalised rows, and
+    postings_by_doc come from build_postings_by_doc.
+
+    Every article ends up as a reference (of its own cluster or the one it
+    joined), so the references seen by article idx are exactly 0..idx-1,
+    whatever the LLM decided for them. That is what lets us start the
+    comparisons of later articles ahead of time.
+    """
+    # Scoring only walks the postings of the article's own terms, and skips
+    # the bucket of its own document entirely. Rows are L2-normalised, so
+    # the summed products are the cosine similarities. Going block by block
+    # keeps the dense similarity vector small and stops at the first block
+    # that only holds later articles.
+    row = tfidf_matrix[idx]
+    doc_id = doc_ids[idx]
+    candidates = []
+    for other_doc_id, blocks in postings_by_doc.items():
+        if other_doc_id == doc_id:
+            continue
+        for rows, postings in blocks:
+            # rows are ascending, so the earlier articles are a prefix
+            n_earlier = np.searchsorted(rows, idx)
+            if not n_earlier:
+                break
+            sims = (postings[:, row.indices] @ row.data)[:n_earlier]
+            candidates.extend(rows[:n_earlier][sims >= tfidf_threshold].tolist())
+    return sorted(candidates)
+
+
+def bm25_neighbours(corpus, k=BM25_TOP_K):
+    """
+    For every text in the corpus, the indices of its k best BM25 matches in
+    the corpus (itself excluded), best first. All texts are queried in one
+    call against bm25s' inverted index, so only the postings of each
+    query's terms are scanned.
+    """
+    import bm25s
+
+    tokens = bm25s.tokenize(corpus, stopwords="en", show_progress=False)
+    retriever = bm25s.BM25()
+    retriever.index(tokens, show_progress=False)
+    results, scores = retriever.retrieve(
+        tokens, k=min(k + 1, len(corpus)), show_progress=False
+    )
+    return [
+        [int(j) for j, score in zip(row, row_scores) if j != i and score > 0][:k]
+        for i, (row, row_scores) in enumerate(zip(results, scores))
+    ]
+
+
+def bm25_candidates(neighbours, doc_ids, idx):
+    """
+    Like tfidf_candidates, but from the precomputed BM25 neighbours: the
+    earlier articles from other documents among idx's best matches.
+    """
+    doc_id = doc_ids[idx]
+    return [
+        ref_idx
+        for ref_idx in neighbours[idx]
+        if ref_idx < idx and doc_ids[ref_idx] != doc_id
+    ]
+
+
 # -----------------------------
 # Cluster articles with TF-IDF pre-filter
 # -----------------------------
 def cluster_articles_with_tfidf(
-    articles, tfidf_threshold=0.2, llm_threshold=0.8, early_exit=0.95
+    articles,
+    tfidf_threshold=0.2,
+    llm_threshold=0.8,
+    early_exit=0.95,
+    embedding_band=None,
+    log_path=CLUSTER_LOG_PATH,
 ):
     """
     Cluster articles using TF-IDF to pre-select candidate references for LLM comparison.
+
+    With embedding_band=(low, high), candidates are re-ranked by embedding
+    cosine first and only the uncertain ones (low < cosine < high) are
+    compared by the LLM; see EMBED_MODEL.
+
+    Every decision is appended to the JSONL file log_path as it is made. If
+    the run stops, the next run with the same articles and parameters
+    replays the logged decisions and continues after the last one.
     """
-    reference_indices = []  # Track indices of reference articles
+    return asyncio.run(
+        cluster_articles_with_tfidf_async(
+            articles,
+            tfidf_threshold,
+            llm_threshold,
+            early_exit,
+            embedding_band,
+            log_path,
+        )
+    )
+
+
+async def cluster_articles_with_tfidf_async(
+    articles,
+    tfidf_threshold=0.2,
+    llm_threshold=0.8,
+    early_exit=0.95,
+    embedding_band=None,
+    log_path=CLUSTER_LOG_PATH,
+):
+    params = {
+        "tfidf_threshold": tfidf_threshold,
+        "llm_threshold": llm_threshold,
+        "early_exit": early_exit,
+        "embedding_band": embedding_band and list(embedding_band),
+        "candidate_retriever": CANDIDATE_RETRIEVER,
+        "model": SCORE_MODEL,
+    }
+    decisions = load_cluster_log(log_path, params)
+    labels = [article_label(a) for a in articles]
+    if [d["article_label"] for d in decisions] != labels[: len(decisions)]:
+        logger.warning("%s is for a different article list, starting over", log_path)
+        decisions = []
+
+    limits = httpx.Limits(
+        max_connections=CONCURRENCY, max_keepalive_connections=CONCURRENCY
+    )
+    with shelve.open(SCORE_CACHE_PATH) as cache, open(
+        log_path, "ab" if decisions else "wb"
+    ) as log:
+        if decisions:
+            logger.info("Resuming after %d decisions in %s", len(decisions), log_path)
+            if not _ends_with_newline(log_path):
+                log.write(b"\n")
+        else:
+            log.write(orjson.dumps({"params": params}) + b"\n")
+
+        async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT, limits=limits) as client:
+            return await _cluster_articles(
+                client,
+                cache,
+                log,
+                decisions,
+                articles,
+                labels,
+                tfidf_threshold,
+                llm_threshold,
+                early_exit,
+                embedding_band,
+            )
+
+
+async def _cluster_articles(
+    client,
+    cache,
+    log,
+    decisions,
+    articles,
+    labels,
+    tfidf_threshold,
+    llm_threshold,
+    early_exit,
+    embedding_band,
+):
+    sem = asyncio.Semaphore(CONCURRENCY)
     reference_to_label = {}  # Map article index to cluster label
     clusters = {}
 
-    # Precompute TF-IDF for all articles
-    corpus = [build_article_text(a) for a in articles]
-    vectorizer = TfidfVectorizer(stop_words="english")
-    tfidf_matrix = vectorizer.fit_transform(corpus)
+    def assign(idx, cluster_label, is_reference):
+        reference_to_label[idx] = cluster_label
+        entry = {"article": articles[idx], "reference_article": is_reference}
+        if is_reference:
+            clusters[cluster_label] = [entry]
+        else:
+            clusters[cluster_label].append(entry)
+
+    def decide(idx, cluster_label, is_reference):
+        # Record the decision right away, so a crashed run can resume here
+        assign(idx, cluster_label, is_reference)
+        record = {
+            "index": idx,
+            "article_label": labels[idx],
+            "assigned_to": cluster_label,
+            "is_reference": is_reference,
+        }
+        log.write(orjson.dumps(record) + b"\n")
+        log.flush()
+
+    # Replay the decisions of a previous run of the same job
+    for d in decisions:
+        assign(d["index"], d["assigned_to"], d["is_reference"])
+    first_idx = len(decisions)
 
-    for idx, article in enumerate(articles):
-        article_label = (
-            f"{article.get('document name', '')} {article.get('article id', '')}"
-        )
-        print(
-            f"\n\033[96m[{idx+1}/{len(articles)}]\033[0m Processing article {article_label}"
+    corpus = [build_article_text(a) for a in articles]
+    doc_ids = encode_documents(articles)
+    if CANDIDATE_RETRIEVER == "bm25":
+        neighbours = bm25_neighbours(corpus)
+
+        def candidates_for(i):
+            return bm25_candidates(neighbours, doc_ids, i)
+
+    else:
+        # Precompute TF-IDF for all articles. Hashing the terms avoids
+        # building a vocabulary (one pass over the corpus instead of two);
+        # TfidfTransformer adds the idf weights and L2-normalises the rows.
+        vectorizer = HashingVectorizer(
+            n_features=HASH_FEATURES,
+            alternate_sign=False,
+            norm=None,
+            stop_words="english",
         )
+        tfidf_matrix = TfidfTransformer().fit_transform(vectorizer.transform(corpus))
+        tfidf_matrix = tfidf_matrix.tocsr()
+        postings_by_doc = build_postings_by_doc(tfidf_matrix, doc_ids)
 
-        if idx == 0:
-            # first article becomes reference
-            reference_indices.append(idx)
-            reference_to_label[idx] = article_label
-            clusters[article_label] = [{"article": article, "reference_article": True}]
-            print(f"→ Added as first reference")
-            continue
+        def candidates_for(i):
+            return tfidf_candidates(
+                tfidf_matrix, postings_by_doc, doc_ids, i, tfidf_threshold
+            )
+
+    if embedding_band is not None:
+        embeddings = await embed_texts(client, corpus)
 
-        # Compute TF-IDF cosine similarity to all references
-        candidate_refs = []
-        article_vec = tfidf_matrix[idx]
+    def start(i):
+        candidate_refs = candidates_for(i)
+        known = None
+        if embedding_band is not None and candidate_refs:
+            known = embedding_verdicts(embeddings, i, candidate_refs, embedding_band)
+        return start_comparisons(client, sem, cache, corpus, i, candidate_refs, known)
 
-        for ref_idx in reference_indices:
-            ref_vec = tfidf_matrix[ref_idx]
-            sim = cosine_similarity(article_vec, ref_vec)[0][0]
+    # article idx -> tasks of the comparisons already started. The
+    # comparisons of the next LOOKAHEAD articles run while the current one
+    # is decided; only the cluster assignment itself is sequential.
+    started = {}
+    next_to_start = max(first_idx, 1)
+
+    try:
+        for idx in range(first_idx, len(articles)):
+            label = labels[idx]
+            logger.info(
+                "\n\033[96m[%d/%d]\033[0m Processing article %s",
+                idx + 1,
+                len(articles),
+                label,
+            )
 
-            # skip same-document references
-            if article.get("document name") == articles[ref_idx].get("document name"):
+            if idx == 0:
+                # first article becomes reference
+                decide(idx, label, True)
+                logger.info("→ Added as first reference")
                 continue
 
-            if sim >= tfidf_threshold:
-                candidate_refs.append(ref_idx)
+            while next_to_start < min(idx + 1 + LOOKAHEAD, len(articles)):
+                started[next_to_start] = start(next_to_start)
+                next_to_start += 1
+            tasks = started.pop(idx)
 
-        if not candidate_refs:
-            # No candidate references -> add as new reference
-            reference_indices.append(idx)
-            reference_to_label[idx] = article_label
-            clusters[article_label] = [{"article": article, "reference_article": True}]
-            print(f"→ No TF-IDF candidates, added as new reference")
-            continue
+            if not tasks:
+                # No candidate references -> add as new reference
+                decide(idx, label, True)
+                logger.info("→ No candidates, added as new reference")
+                continue
 
-        # Compare with candidate references using LLM
-        best_score = -5.0
-        best_ref_label = None
-        best_ref_idx = None
-        prelim_matches = []
-
-        for ref_idx in candidate_refs:
-            ref_label = reference_to_label[ref_idx]
-            score = compare_articles_score(article, articles[ref_idx])
-            print(
-                f"   Compared {article_label} -> {ref_label}: LLM similarity {score:.2f}"
-            )
+            # Compare with candidate references using LLM
+            best_score = -5.0
+            best_ref_label = None
+            best_ref_idx = None
+            prelim_matches = []
 
-            if score > llm_threshold:
-                prelim_matches.append((ref_label, score, ref_idx))
+            scores = await collect_scores(tasks, early_exit)
+            for ref_idx, score in scores.items():
+                ref_label = reference_to_label[ref_idx]
+                logger.debug(
+                    "   Compared %s -> %s: LLM similarity %.2f", label, ref_label, score
+                )
 
-            if score > best_score:
-                best_score = score
-                best_ref_label = ref_label
-                best_ref_idx = ref_idx
+                if score > llm_threshold:
+                    prelim_matches.append((ref_label, score, ref_idx))
 
-            if score >= early_exit:
-                # early exit if very high similarity
-                print(f"     → Early exit: similarity {score:.2f} >= {early_exit}")
-                prelim_matches = [(ref_label, score, ref_idx)]
-                best_score = score
-                best_ref_label = ref_label
-                best_ref_idx = ref_idx
-                break
+                if score > best_score:
+                    best_score = score
+                    best_ref_label = ref_label
+                    best_ref_idx = ref_idx
 
-        if prelim_matches:
-            chosen_ref_label = max(prelim_matches, key=lambda x: x[1])[0]
-            clusters[chosen_ref_label].append(
-                {"article": article, "reference_article": False}
-            )
-            # Add matched article as a candidate reference for future articles
-            # Store the cluster label (not article_label) so future lookups work
-            reference_indices.append(idx)
-            reference_to_label[idx] = chosen_ref_label
-            print(f"→ {article_label} assigned to {chosen_ref_label}")
-        else:
-            reference_indices.append(idx)
-            reference_to_label[idx] = article_label
-            clusters[article_label] = [{"article": article, "reference_article": True}]
-            print(
-                f"→ {article_label} did not match any reference, added as new reference"
-            )
+            if best_score >= early_exit:
+                # early exit if very high similarity
+                logger.debug(
+                    "     → Early exit: similarity %.2f >= %s", best_score, early_exit
+                )
+                prelim_matches = [(best_ref_label, best_score, best_ref_idx)]
+
+            if prelim_matches:
+                chosen_ref_label = max(prelim_matches, key=lambda x: x[1])[0]
+                # The matched article stays a candidate reference for future
+                # articles, under the cluster label (not its own label) so
+                # future lookups work
+                decide(idx, chosen_ref_label, False)
+                logger.info("→ %s assigned to %s", label, chosen_ref_label)
+            else:
+                decide(idx, label, True)
+                logger.info(
+                    "→ %s did not match any reference, added as new reference", label
+                )
+    finally:
+        for tasks in started.values():
+            for task in tasks:
+                task.cancel()
 
     return clusters
 
 
+def load_cluster_log(log_path, params):
+    """
+    The decisions recorded in a cluster log by a previous run with the same
+    params, in article order. Returns [] if there is no log or it was
+    written with other params. A truncated last line (e.g. after a crash)
+    is ignored.
+    """
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path, "rb") as f:
+        lines = f.read().splitlines()
+    try:
+        if orjson.loads(lines[0]) != {"params": params}:
+            return []
+    except (IndexError, orjson.JSONDecodeError):
+        return []
+
+    decisions = []
+    for line in lines[1:]:
+        try:
+            decisions.append(orjson.loads(line))
+        except orjson.JSONDecodeError:
+            break
+    return decisions
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
 # -----------------------------
 # Save clustered JSON
 # -----------------------------
@@ -180,26 +696,22 @@ def save_clusters_to_json(clusters, filename="clustered_articles.json"):
         cluster_data = {"reference_label": ref_label, "articles": articles_list}
         output.append(cluster_data)
 
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(output, f, indent=4, ensure_ascii=False)
-    print(f"\n Clustered articles saved to {filename}")
+    with open(filename, "wb") as f:
+        f.write(orjson.dumps(output, option=orjson.OPT_INDENT_2))
+    logger.info("\n Clustered articles saved to %s", filename)
 
 
 # -----------------------------
 # MAIN
 # -----------------------------
 if __name__ == "__main__":
-    # Load articles from JSON
-    with open(
-        "categorized_cleaned_data/compliance_risk_eba_sanitized.json",
-        "r",
-        encoding="utf-8",
-    ) as f:
-        data1 = json.load(f)
-    with open(
-        "categorized_cleaned_data/compliance_risk_fiva_mok.json", "r", encoding="utf-8"
-    ) as f:
-        data2 = json.load(f)
+    # LOG_LEVEL=DEBUG also shows every single LLM comparison
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(message)s")
+
+    # Load articles: the JSONL files split_by_risk_category.py writes, or
+    # older JSON lists
+    data1 = load_articles("categorized_cleaned_data/compliance_risk_eba_sanitized.json")
+    data2 = load_articles("categorized_cleaned_data/compliance_risk_fiva_mok.json")
 
     articles = data1 + data2
 
@@ -211,6 +723,7 @@ if __name__ == "__main__":
         # llm_threshold=0.7,  # preliminary LLM match
         llm_threshold=0.84,  # preliminary LLM match
         early_exit=0.91,  # stop LLM comparisons if very high similarity
+        # embedding_band=(0.5, 0.85),  # only ask the LLM when embeddings are unsure
     )
 
     save_clusters_to_json(clusters)
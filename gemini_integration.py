@@ -1,10 +1,65 @@
 import os
-import json
+import orjson
+import time
+import random
+import shelve
+import hashlib
+import asyncio
+import tempfile
 import itertools
+import httpx
 from google import genai
+from google.genai import errors
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+
+try:
+    from aiolimiter import AsyncLimiter
+except ImportError:
+    AsyncLimiter = None
 
 # Gemini API settings
 GEMINI_MODEL = "gemini-2.5-flash"  # or another Gemini model name
+# Max number of Gemini requests in flight at once
+GEMINI_CONCURRENCY = 32
+# Requests per minute allowed by the account quota for GEMINI_MODEL
+GEMINI_RPM = int(os.environ.get("GEMINI_RPM", "1000"))
+# Rate-limited (429) and transient server errors are retried this many
+# times, with exponential backoff capped at RETRY_MAX_DELAY seconds
+MAX_RETRIES = 6
+RETRY_MAX_DELAY = 60
+RETRY_STATUS_CODES = {429, 500, 503, 504}
+
+# How the pairs are sent to Gemini:
+#   "online" - one concurrent generate_content request per pair
+#   "batch"  - all prompts in ONE Batch Mode job (about half the price, but
+#              results can take up to a day); for offline runs
+GEMINI_MODE = os.environ.get("GEMINI_MODE", "online")
+# Seconds between status checks of a running batch job
+BATCH_POLL_INTERVAL = 30
+# Pairs whose TF-IDF cosine similarity is below this share no concrete
+# vocabulary and are labelled 'bloat' without asking Gemini
+BLOAT_SIM_THRESHOLD = 0.15
+
+# Persistent cache of pair classifications so re-runs skip Gemini
+CACHE_PATH = "gemini_cache.db"
+
+# Pairs classified together in one prompt, so the instructions are only
+# sent once per group instead of once per pair
+PAIRS_PER_PROMPT = 16
+# Labels in decision order, and the fallback for answers that only give
+# the first letter or similar
+LABELS = ("contradiction", "overlap", "bloat")
+_FIRST_CHAR_LABEL = {label[0]: label for label in LABELS}
+# Structured output for a group: a JSON array with one label per pair
+LABEL_LIST_SCHEMA = {"type": "ARRAY", "items": {"type": "STRING", "enum": list(LABELS)}}
+
+BATCH_DONE_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
 
 # Expect the API key in the environment for safety
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
@@ -14,8 +69,30 @@ if not GEMINI_API_KEY:
         "Create an API key in Google AI Studio and export GEMINI_API_KEY."
     )
 
-# Create a single client to reuse
-client = genai.Client(api_key=GEMINI_API_KEY)
+# Connection pool of the Gemini client: every request the semaphore lets
+# through finds a warm keep-alive connection, with headroom for batch
+# uploads and status polls. HTTP/2 multiplexes requests over them.
+GEMINI_LIMITS = httpx.Limits(
+    max_connections=4 * GEMINI_CONCURRENCY,
+    max_keepalive_connections=2 * GEMINI_CONCURRENCY,
+)
+
+# Create a single client to reuse; client.aio shares its settings
+client = genai.Client(
+    api_key=GEMINI_API_KEY,
+    http_options={
+        "client_args": {
+            "transport": httpx.HTTPTransport(
+                http2=True, retries=2, limits=GEMINI_LIMITS
+            ),
+        },
+        "async_client_args": {
+            "transport": httpx.AsyncHTTPTransport(
+                http2=True, retries=2, limits=GEMINI_LIMITS
+            ),
+        },
+    },
+)
 
 CLASSIFICATION_INSTRUCTIONS = """
 Compare Paragraph A and Paragraph B. Output one label: contradiction, overlap, or bloat.
@@ -53,6 +130,46 @@ Output: one lowercase word, nothing else.
 """
 
 
+class RateLimiter:
+    """
+    Lets at most `rate` requests start per `period` seconds, spaced evenly.
+    Stand-in for aiolimiter.AsyncLimiter when that isn't installed.
+    """
+
+    def __init__(self, rate: float, period: float = 60):
+        self.interval = period / rate
+        self.next_start = 0.0
+
+    async def __aenter__(self):
+        now = time.monotonic()
+        wait = self.next_start - now
+        self.next_start = max(now, self.next_start) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+# Shared by all async requests, so the RPM cap holds across the whole run
+rate_limit = (AsyncLimiter or RateLimiter)(GEMINI_RPM, 60)
+
+
+async def _with_retry(coro_fn, *args, **kwargs):
+    """
+    Await coro_fn(*args, **kwargs) under the RPM limit, retrying rate-limit
+    and transient server errors with exponential backoff and jitter.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with rate_limit:
+                return await coro_fn(*args, **kwargs)
+        except errors.APIError as e:
+            if e.code not in RETRY_STATUS_CODES or attempt == MAX_RETRIES:
+                raise
+        await asyncio.sleep(min(RETRY_MAX_DELAY, 2**attempt + random.random()))
+
+
 def call_gemini(prompt: str, temperature: float = 0.1) -> str:
     """
     Call the Gemini SDK and normalise the output
@@ -65,42 +182,260 @@ def call_gemini(prompt: str, temperature: float = 0.1) -> str:
             "temperature": temperature,
         },
     )
-
     # response.text is the concatenated text output
-    raw = (response.text or "").strip().lower()
+    return normalise_label(response.text or "")
 
-    # Normalise to one of the three labels
-    if "contradiction" in raw:
-        return "contradiction"
-    if "overlap" in raw:
-        return "overlap"
-    if "bloat" in raw:
-        return "bloat"
 
-    # Fallbacks if it only gives first letters or similar
-    if raw.startswith("c"):
-        return "contradiction"
-    if raw.startswith("o"):
-        return "overlap"
-    if raw.startswith("b"):
-        return "bloat"
+async def call_gemini_async(prompt: str, temperature: float = 0.1) -> str:
+    """
+    Async version of call_gemini, through the client's aio interface;
+    rate limited and retried by _with_retry.
+    """
+    response = await _with_retry(
+        client.aio.models.generate_content,
+        model=GEMINI_MODEL,
+        contents=prompt,
+        config={
+            "temperature": temperature,
+        },
+    )
+    return normalise_label(response.text or "")
+
+
+def normalise_label(raw: str) -> str:
+    """
+    Map a raw model answer to one of: 'contradiction', 'overlap', 'bloat'.
+    """
+    raw = raw.strip().lower()
+    # Structured output gives the bare label
+    if raw in LABELS:
+        return raw
+
+    for label in LABELS:
+        if label in raw:
+            return label
+    try:
+        return _FIRST_CHAR_LABEL[raw[:1]]
+    except KeyError:
+        raise ValueError(f"Model did not answer with a valid label: {raw}") from None
 
-    raise ValueError(f"Model did not answer with a valid label: {raw}")
+
+def build_prompt(p_a: str, p_b: str) -> str:
+    return f"""{CLASSIFICATION_INSTRUCTIONS}
+
+Paragraph A:
+\"\"\"{p_a}\"\"\"
+
+Paragraph B:
+\"\"\"{p_b}\"\"\"
+"""
 
 
 def classify_paragraph_pair(p_a: str, p_b: str) -> str:
     """
     Return one of: 'contradiction', 'overlap', 'bloat'.
     """
-    prompt = f"""{CLASSIFICATION_INSTRUCTIONS}
+    return call_gemini(build_prompt(p_a, p_b))
 
+
+def build_pairs_prompt(pairs: list) -> str:
+    """
+    One prompt for several (p_a, p_b) pairs, each classified on its own.
+    """
+    rendered = "\n\n".join(
+        f"""### Pair {k}
 Paragraph A:
 \"\"\"{p_a}\"\"\"
 
 Paragraph B:
 \"\"\"{p_b}\"\"\"
 """
-    return call_gemini(prompt)
+        for k, (p_a, p_b) in enumerate(pairs, start=1)
+    )
+    return f"""{CLASSIFICATION_INSTRUCTIONS}
+Below are {len(pairs)} pairs. Classify each pair independently.
+Output a JSON array of {len(pairs)} labels, one per pair, in order, nothing else.
+
+{rendered}"""
+
+
+def pairs_config(temperature: float = 0.1) -> dict:
+    return {
+        "temperature": temperature,
+        "response_mime_type": "application/json",
+        "response_schema": LABEL_LIST_SCHEMA,
+    }
+
+
+def parse_labels(raw: str, n: int) -> list:
+    """
+    Parse the JSON array answer to a build_pairs_prompt prompt. Raises
+    ValueError unless it holds exactly n valid labels.
+    """
+    labels = orjson.loads(raw)  # JSONDecodeError is a ValueError
+    if not isinstance(labels, list) or len(labels) != n:
+        raise ValueError(f"Expected {n} labels, got: {raw}")
+    return [normalise_label(str(label)) for label in labels]
+
+
+def classify_paragraph_pairs(pairs: list) -> list:
+    """
+    Labels for a list of (p_a, p_b) pairs from a single request. Falls back
+    to one request per pair if the answer doesn't fit.
+    """
+    response = client.models.generate_content(
+        model=GEMINI_MODEL,
+        contents=build_pairs_prompt(pairs),
+        config=pairs_config(),
+    )
+    try:
+        return parse_labels(response.text or "", len(pairs))
+    except ValueError:
+        return [classify_paragraph_pair(p_a, p_b) for p_a, p_b in pairs]
+
+
+async def aclassify_paragraph_pairs(pairs: list, sem: asyncio.Semaphore) -> list:
+    """
+    Async version of classify_paragraph_pairs.
+    """
+    if len(pairs) == 1:
+        return [await aclassify_paragraph_pair(*pairs[0], sem)]
+    async with sem:
+        response = await _with_retry(
+            client.aio.models.generate_content,
+            model=GEMINI_MODEL,
+            contents=build_pairs_prompt(pairs),
+            config=pairs_config(),
+        )
+    try:
+        return parse_labels(response.text or "", len(pairs))
+    except ValueError:
+        return list(
+            await asyncio.gather(
+                *(aclassify_paragraph_pair(p_a, p_b, sem) for p_a, p_b in pairs)
+            )
+        )
+
+
+def chunked(items: list, size: int) -> list:
+    return [items[k : k + size] for k in range(0, len(items), size)]
+
+
+async def aclassify_paragraph_pair(
+    p_a: str, p_b: str, sem: asyncio.Semaphore
+) -> str:
+    """
+    Async version of classify_paragraph_pair. The semaphore caps the number
+    of requests in flight.
+    """
+    async with sem:
+        return await call_gemini_async(build_prompt(p_a, p_b))
+
+
+def submit_batch(prompts: list, generation_config: dict) -> list:
+    """
+    Run all prompts as one Gemini Batch Mode job and wait for it to finish.
+
+    Returns the raw answer text per prompt, in order; None for the requests
+    of the job that failed.
+    """
+    with tempfile.NamedTemporaryFile("wb", suffix=".jsonl", delete=False) as f:
+        for k, prompt in enumerate(prompts):
+            request = {
+                "key": str(k),
+                "request": {
+                    "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+                    "generation_config": generation_config,
+                },
+            }
+            f.write(orjson.dumps(request) + b"\n")
+    try:
+        src = client.files.upload(
+            file=f.name,
+            config={"display_name": "pair-classification", "mime_type": "jsonl"},
+        )
+    finally:
+        os.remove(f.name)
+
+    job = client.batches.create(
+        model=GEMINI_MODEL,
+        src=src.name,
+        config={"display_name": "pair-classification"},
+    )
+    while job.state.name not in BATCH_DONE_STATES:
+        time.sleep(BATCH_POLL_INTERVAL)
+        job = client.batches.get(name=job.name)
+    if job.state.name != "JOB_STATE_SUCCEEDED":
+        raise RuntimeError(f"Gemini batch job {job.name} ended as {job.state.name}")
+
+    answers = [None] * len(prompts)
+    for line in client.files.download(file=job.dest.file_name).splitlines():
+        if not line.strip():
+            continue
+        result = orjson.loads(line)
+        try:
+            parts = result["response"]["candidates"][0]["content"]["parts"]
+        except (KeyError, IndexError):
+            continue  # this request failed; result["error"] says why
+        answers[int(result["key"])] = "".join(p.get("text", "") for p in parts)
+    return answers
+
+
+async def classify_pairs_batch(pairs: list, sem: asyncio.Semaphore) -> list:
+    """
+    Labels for (p_a, p_b) pairs through one batch job, PAIRS_PER_PROMPT
+    pairs per request. Groups that failed inside the job, or whose answer
+    doesn't fit, are retried as normal online requests.
+    """
+    groups = chunked(pairs, PAIRS_PER_PROMPT)
+    answers = await asyncio.to_thread(
+        submit_batch, [build_pairs_prompt(g) for g in groups], pairs_config()
+    )
+
+    async def labels_for(group, answer):
+        if answer is not None:
+            try:
+                return parse_labels(answer, len(group))
+            except ValueError:
+                pass
+        return await aclassify_paragraph_pairs(group, sem)
+
+    results = await asyncio.gather(
+        *(labels_for(g, answer) for g, answer in zip(groups, answers))
+    )
+    return [label for labels in results for label in labels]
+
+
+def text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def pair_key(hash_a: str, hash_b: str) -> str:
+    """
+    Cache key of a pair of texts, given their text_hash. The relation is
+    symmetric, so (A, B) and (B, A) map to the same key; labels of different
+    models are kept apart.
+    """
+    return f"{GEMINI_MODEL}:" + "|".join(sorted((hash_a, hash_b)))
+
+
+def texts_path_for(output_path: str) -> str:
+    """
+    Sidecar file that stores the full article texts, keyed by text_hash.
+    """
+    return os.path.splitext(output_path)[0] + "_texts.json"
+
+
+def tfidf_similarity_matrix(texts: list):
+    """
+    Dense k x k TF-IDF cosine similarity matrix for the given texts.
+    """
+    try:
+        tfidf_matrix = TfidfVectorizer(stop_words="english").fit_transform(texts)
+    except ValueError:
+        # empty vocabulary: nothing in common at all
+        return [[0.0] * len(texts) for _ in texts]
+    return cosine_similarity(tfidf_matrix)
 
 
 def summarize_relations(results: list) -> dict:
@@ -125,7 +460,22 @@ def summarize_relations(results: list) -> dict:
 
 def analyse_clustered_file(
     json_path: str,
-    output_path: str = "relations_output.json"
+    output_path: str = "relations_output.jsonl",
+    cache_path: str = CACHE_PATH,
+) -> list:
+    """
+    Blocking wrapper around analyse_clustered_file_async for CLI use.
+    """
+    return asyncio.run(
+        analyse_clustered_file_async(json_path, output_path, cache_path=cache_path)
+    )
+
+
+async def analyse_clustered_file_async(
+    json_path: str,
+    output_path: str = "relations_output.jsonl",
+    concurrency: int = GEMINI_CONCURRENCY,
+    cache_path: str = CACHE_PATH,
 ) -> list:
     """
     Run analysis on a single clustered file with structure like
@@ -152,59 +502,134 @@ def analyse_clustered_file(
     - Within each subcategory, each entry in "articles" is an article.
     - We compare WHOLE articles (all paragraphs concatenated) ONLY
       between different articles within the same subcategory.
+
+    Pairs are classified in groups of PAIRS_PER_PROMPT per request, with
+    the requests sent concurrently (at most `concurrency` at a time), or
+    as one batch job when GEMINI_MODE is "batch". Pairs with TF-IDF
+    similarity below BLOAT_SIM_THRESHOLD are labelled 'bloat' directly,
+    articles identical up to whitespace 'overlap', and labels already in
+    the cache at cache_path are reused.
+
+    Output:
+    - `output_path` is JSONL, one relation record per line, written as soon
+      as the relation is known. Records only reference the article texts by
+      hash; the texts themselves are written once to `<output>_texts.json`,
+      before any pair is sent to Gemini.
+    - A re-run rewrites both; labels of an interrupted run come back from
+      the cache, which is updated as soon as each label is known.
     """
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    with open(json_path, "rb") as f:
+        data = orjson.loads(f.read())
 
     all_results = []
-
-    for subcat in data:
-        subcat_label = subcat.get("reference_label", "UNKNOWN_SUBCATEGORY")
-        articles = subcat.get("articles", [])
-
-        # All pairs of DIFFERENT articles: i != j
-        for i, j in itertools.combinations(range(len(articles)), 2):
-            art_a = articles[i].get("article", {})
-            art_b = articles[j].get("article", {})
-
-            art_a_id = art_a.get("article id", f"article_{i}")
-            art_b_id = art_b.get("article id", f"article_{j}")
-
-            paras_a = art_a.get("article paragraphs", []) or []
-            paras_b = art_b.get("article paragraphs", []) or []
-
-            # Skip empty articles
-            if not paras_a or not paras_b:
-                continue
-
-            # Compare full article texts (concatenate all paragraphs)
-            text_a = "\n\n".join(paras_a)
-            text_b = "\n\n".join(paras_b)
-
-            relation = classify_paragraph_pair(text_a, text_b)
-
-            all_results.append(
-                {
+    pending = []  # records still waiting for a relation
+    texts_by_hash = {}
+
+    with open(output_path, "wb") as out:
+        def emit(record):
+            out.write(orjson.dumps(record) + b"\n")
+            all_results.append(record)
+
+        for subcat in data:
+            subcat_label = subcat.get("reference_label", "UNKNOWN_SUBCATEGORY")
+            articles = subcat.get("articles", [])
+
+            # Look up each article's id and join its paragraphs once, not
+            # once per pair, and leave out empty articles up front
+            ids, texts = [], []
+            for k, a in enumerate(articles):
+                art = a.get("article", {})
+                text = "\n\n".join(art.get("article paragraphs", []) or [])
+                if text:
+                    ids.append(art.get("article id", f"article_{k}"))
+                    texts.append(text)
+            sims = tfidf_similarity_matrix(texts)
+            hashes = [text_hash(text) for text in texts]
+            texts_by_hash.update(zip(hashes, texts))
+            # Copy-pasted articles only differ in whitespace, if at all
+            dup_keys = [text_hash(" ".join(text.split())) for text in texts]
+
+            # All pairs of DIFFERENT articles: i != j
+            for i, j in itertools.combinations(range(len(texts)), 2):
+                record = {
                     "subcategory": subcat_label,
-                    "section_a_id": art_a_id,
-                    "section_b_id": art_b_id,
+                    "section_a_id": ids[i],
+                    "section_b_id": ids[j],
                     # Indices are not meaningful at article level; set to None
                     "paragraph_a_index": None,
                     "paragraph_b_index": None,
-                    # These now contain the FULL article texts
-                    "paragraph_a_text": text_a,
-                    "paragraph_b_text": text_b,
-                    "relation": relation,  # 'overlap', 'contradiction', or 'bloat'
+                    # Full article texts (all paragraphs concatenated) are in
+                    # the _texts.json sidecar
+                    "text_a_hash": hashes[i],
+                    "text_b_hash": hashes[j],
+                    "relation": None,  # 'overlap', 'contradiction', or 'bloat'
                 }
-            )
-
-    # save all article-level relations
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(all_results, f, indent=2, ensure_ascii=False)
+                if dup_keys[i] == dup_keys[j]:
+                    record["relation"] = "overlap"
+                    emit(record)
+                elif sims[i][j] < BLOAT_SIM_THRESHOLD:
+                    record["relation"] = "bloat"
+                    emit(record)
+                else:
+                    pending.append(record)
+            out.flush()
+
+        # save the article texts referenced by the relation records before
+        # the slow part, so what's in the output resolves even after a crash
+        with open(texts_path_for(output_path), "wb") as f:
+            f.write(orjson.dumps(texts_by_hash, option=orjson.OPT_INDENT_2))
+
+        with shelve.open(cache_path) as cache:
+            await classify_records(pending, texts_by_hash, cache, concurrency, emit)
 
     return all_results
 
 
+async def classify_records(
+    records: list, texts_by_hash: dict, cache, concurrency: int, emit
+) -> None:
+    """
+    Fill in the relation of each record from the cache or, for pairs not
+    seen before, from Gemini, and pass each record to `emit` once its
+    relation is known. Each distinct pair is classified only once.
+    """
+    waiting = {}  # cache key -> records of that pair
+    for r in records:
+        key = pair_key(r["text_a_hash"], r["text_b_hash"])
+        if key in cache:
+            r["relation"] = cache[key]
+            emit(r)
+        else:
+            waiting.setdefault(key, []).append(r)
+    if not waiting:
+        return
+
+    def pair_of(key):
+        r = waiting[key][0]
+        return texts_by_hash[r["text_a_hash"]], texts_by_hash[r["text_b_hash"]]
+
+    def store(keys, relations):
+        # cached as soon as known, so an interrupted run keeps its labels
+        for key, relation in zip(keys, relations):
+            cache[key] = relation
+            for r in waiting[key]:
+                r["relation"] = relation
+                emit(r)
+
+    sem = asyncio.Semaphore(concurrency)
+    keys = list(waiting)
+    if GEMINI_MODE == "batch":
+        store(keys, await classify_pairs_batch([pair_of(k) for k in keys], sem))
+        return
+
+    async def classify_group(group):
+        store(group, await aclassify_paragraph_pairs([pair_of(k) for k in group], sem))
+
+    await asyncio.gather(
+        *(classify_group(group) for group in chunked(keys, PAIRS_PER_PROMPT))
+    )
+
+
 if __name__ == "__main__":
     # Example usage with your file:
     results = analyse_clustered_file(
@@ -0,0 +1,180 @@
+"""
+Local LLM calls shared by select_relevant.py and split_by_risk_category.py:
+Ollama's chat API (or a vLLM server, see LLM_BACKEND), one prompt in, the
+stripped answer out.
+
+The instructions an article is classified with go in the system message and
+the article in the user message. The system message is the same for every
+article, so Ollama reuses its KV cache instead of re-processing it; start
+the server with OLLAMA_FLASH_ATTENTION=1 for faster attention on long
+articles as well.
+"""
+import os
+import asyncio
+import itertools
+import httpx
+import requests
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Iterable, List, Optional, Tuple
+
+OLLAMA_URL = "http://127.0.0.1:11434/api/chat"
+# 4-bit quantized build of gemma3:4b (ollama pull gemma3:4b-it-q4_K_M);
+# decoding is memory-bandwidth bound, so it needs less VRAM and runs faster.
+MODEL_NAME = os.environ.get("OLLAMA_MODEL", "gemma3:4b-it-q4_K_M")
+# Keep the model (and the cached system prompt) loaded in the Ollama daemon
+# between calls
+KEEP_ALIVE = "30m"
+# Ollama sizes its KV cache by num_ctx and reloads the model whenever it
+# changes, so prompts get the default NUM_CTX and only ones that wouldn't
+# fit (estimated at ~3 characters per token) get MAX_NUM_CTX
+NUM_CTX = 4096
+MAX_NUM_CTX = 8192
+
+# Which server runs the model:
+#   "ollama" - Ollama's /api/chat
+#   "vllm"   - a vLLM OpenAI-compatible server (continuous batching), e.g.
+#              python -m vllm.entrypoints.openai.api_server \
+#                  --model google/gemma-3-4b-it --max-num-seqs 64
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "ollama")
+VLLM_URL = os.environ.get("VLLM_URL", "http://localhost:8000/v1/chat/completions")
+VLLM_MODEL = os.environ.get("VLLM_MODEL", "google/gemma-3-4b-it")
+
+# Max number of articles classified at once. Keep this in line with the
+# OLLAMA_NUM_PARALLEL the server was started with (or vLLM's --max-num-seqs)
+CONCURRENCY = (
+    64 if LLM_BACKEND == "vllm" else int(os.environ.get("OLLAMA_NUM_PARALLEL", "8"))
+)
+REQUEST_TIMEOUT = 600
+# Requests map_in_order starts ahead of the result it is waiting for
+WINDOW = 4 * CONCURRENCY
+
+# One session for all calls so they reuse the same keep-alive connection
+SESSION = requests.Session()
+
+
+def num_ctx_for(prompt: str) -> int:
+    return NUM_CTX if 256 + len(prompt) // 3 <= NUM_CTX else MAX_NUM_CTX
+
+
+def build_llm_request(
+    prompt: str,
+    system: Optional[str] = None,
+    schema: Optional[dict] = None,
+    max_tokens: Optional[int] = None,
+    stop: Optional[List[str]] = None,
+) -> tuple:
+    """
+    (url, payload) of one chat turn on LLM_BACKEND: `system` as the system
+    message, `prompt` as the user message. The answer is constrained to the
+    JSON `schema` if given, and cut at max_tokens or at one of `stop`.
+    """
+    messages = [{"role": "user", "content": prompt}]
+    if system is not None:
+        messages.insert(0, {"role": "system", "content": system})
+
+    if LLM_BACKEND == "vllm":
+        payload = {"model": VLLM_MODEL, "messages": messages, "temperature": 0}
+        if schema is not None:
+            payload["guided_json"] = schema
+        if max_tokens is not None:
+            payload["max_tokens"] = max_tokens
+        if stop is not None:
+            payload["stop"] = stop
+        return VLLM_URL, payload
+
+    options = {
+        "num_ctx": num_ctx_for((system or "") + prompt),
+        "temperature": 0,
+    }
+    if max_tokens is not None:
+        options["num_predict"] = max_tokens
+    if stop is not None:
+        options["stop"] = stop
+    payload = {
+        "model": MODEL_NAME,
+        "messages": messages,
+        "stream": False,
+        "keep_alive": KEEP_ALIVE,
+        "options": options,
+    }
+    if schema is not None:
+        payload["format"] = schema
+    return OLLAMA_URL, payload
+
+
+def response_text(data: dict) -> str:
+    if LLM_BACKEND == "vllm":
+        return (data["choices"][0]["message"]["content"] or "").strip()
+    if "response" in data:
+        # /api/generate, as read.py uses it
+        return (data["response"] or "").strip()
+    return (data["message"]["content"] or "").strip()
+
+
+def query_llm(prompt: str, system: Optional[str] = None, **options) -> str:
+    """
+    Calls Ollama locally with model gemma3:4b (or vLLM, see LLM_BACKEND).
+    Returns the raw model output as a string. `options` are the keyword
+    arguments of build_llm_request.
+    """
+    url, payload = build_llm_request(prompt, system, **options)
+    resp = SESSION.post(url, json=payload, timeout=REQUEST_TIMEOUT)
+    resp.raise_for_status()
+    return response_text(resp.json())
+
+
+async def query_llm_async(
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    prompt: str,
+    system: Optional[str] = None,
+    **options,
+) -> str:
+    """
+    Async version of query_llm. The semaphore caps the number of requests
+    in flight at what the server serves in parallel.
+    """
+    url, payload = build_llm_request(prompt, system, **options)
+    async with sem:
+        resp = await client.post(url, json=payload)
+    resp.raise_for_status()
+    return response_text(resp.json())
+
+
+def make_async_client() -> httpx.AsyncClient:
+    """A client with a keep-alive connection for each of CONCURRENCY requests."""
+    limits = httpx.Limits(
+        max_connections=CONCURRENCY, max_keepalive_connections=CONCURRENCY
+    )
+    return httpx.AsyncClient(timeout=REQUEST_TIMEOUT, limits=limits)
+
+
+async def map_in_order(
+    func: Callable[..., Awaitable], items: Iterable, window: int = WINDOW
+) -> AsyncIterator[Tuple]:
+    """
+    Yield (item, await func(item)) for each of items, in input order, as soon
+    as it and every item before it are done. At most `window` calls run
+    ahead of the one being yielded, so neither the requests nor their
+    answers pile up in memory. A failed request (HTTP error or timeout)
+    yields (item, exception) instead of ending the run.
+    """
+    async def call(item):
+        try:
+            return item, await func(item)
+        except httpx.HTTPError as e:
+            return item, e
+
+    items = iter(items)
+    pending = deque(
+        asyncio.ensure_future(call(item)) for item in itertools.islice(items, window)
+    )
+    try:
+        while pending:
+            result = await pending.popleft()
+            for item in itertools.islice(items, 1):
+                pending.append(asyncio.ensure_future(call(item)))
+            yield result
+    finally:
+        for task in pending:
+            task.cancel()
@@ -1,51 +1,66 @@
-import json
+import orjson
 import os
 import glob
+import itertools
+import mmap
 import re
-from typing import List, Dict, Any
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Iterable, Iterator
+
+try:
+    # Linear-time (DFA) matching for the patterns run on every line
+    import re2 as fast_re
+except ImportError:
+    fast_re = re
 
 # --------------------------------------------------------------------
 # Patterns for headings and numbered paragraphs
 # --------------------------------------------------------------------
 
 # e.g. "4.1 Reportable transactions and content of the report"
-HEADING_RE = re.compile(r'^(\d+(?:\.\d+)*)\s+(.+)$')
+HEADING_RE = fast_re.compile(r'^(\d+(?:\.\d+)*)\s+(.+)$')
 
 # e.g. "(1) leipä", "(2) textiä"
-PARA_START_RE = re.compile(r'^\((\d+)\)\s*(.*)')
+PARA_START_RE = fast_re.compile(r'^\((\d+)\)\s*(.*)')
+
+LETTER_RE = re.compile(r'[A-Za-z]')
 
 MONTHS = (
     "January", "February", "March", "April", "May", "June",
     "July", "August", "September", "October", "November", "December"
 )
+# Any month name, found in one pass over the title
+MONTH_RE = re.compile("|".join(MONTHS))
 
 # --------------------------------------------------------------------
 # Helpers
 # --------------------------------------------------------------------
 
-def load_paragraphs(doc: Dict[str, Any]) -> List[str]:
-    """Flatten all string paragraphs from all pages into a single list."""
-    paragraphs: List[str] = []
+def iter_paragraphs(doc: Dict[str, Any]) -> Iterator[str]:
+    """Yield all string paragraphs from all pages, stripped, in order."""
     for page in doc.get("pages", []):
         for p in page.get("paragraphs", []):
             if isinstance(p, str):
-                paragraphs.append(p.strip())
-    return paragraphs
+                yield p.strip()
 
 
-def guess_document_title(paragraphs: List[str]) -> str:
+def guess_document_title(paragraphs: Iterable[str]) -> str:
     """
     Try to find the main title, typically a line like
     'Regulations and guidelines 4/2018 ...'.
     Fallback: first non-empty paragraph.
+    Only reads as far into `paragraphs` as it needs to.
     """
-    for p in paragraphs[:40]:  # look near the beginning
+    paragraphs = iter(paragraphs)
+    first = ""
+    for p in itertools.islice(paragraphs, 40):  # look near the beginning
         if "Regulations and guidelines" in p:
-            return p.strip()
-    for p in paragraphs:
-        if p.strip():
-            return p.strip()
-    return ""
+            return p
+        if not first:
+            first = p
+    if first:
+        return first
+    return next(filter(None, paragraphs), "")
 
 
 def guess_document_name(file_path: str) -> str:
@@ -68,7 +83,7 @@ def is_probable_article_heading(article_id: str, article_name: str) -> bool:
     - lines with month names / 'until further notice'
     """
     # Page footers / pure numbers: no letters in title
-    if not re.search(r'[A-Za-z]', article_name):
+    if not LETTER_RE.search(article_name):
         return False
 
     # Date-like IDs: e.g. "29.6.2014"
@@ -84,8 +99,9 @@ def is_probable_article_heading(article_id: str, article_name: str) -> bool:
     lower_name = article_name.lower()
 
     # Metadata-style titles (Issued, Valid from, etc.)
-    first_word = article_name.split()[0]
-    if first_word.lower() == "issued" or lower_name.startswith("valid from"):
+    # ("issued" has to be the whole first word)
+    issued = lower_name[:6] == "issued" and not lower_name[6:7].strip()
+    if issued or lower_name.startswith("valid from"):
         return False
 
     # 'until further notice' lines, often combined with dates
@@ -93,7 +109,7 @@ def is_probable_article_heading(article_id: str, article_name: str) -> bool:
         return False
 
     # Month names in the title usually mean it's part of 'Valid from 31 December 2012 ...'
-    if any(m in article_name for m in MONTHS):
+    if MONTH_RE.search(article_name):
         return False
 
     # Other obvious metadata starts
@@ -114,7 +130,7 @@ def is_probable_article_heading(article_id: str, article_name: str) -> bool:
 # Core article parsing
 # --------------------------------------------------------------------
 
-def parse_articles(paragraphs: List[str]) -> List[Dict[str, Any]]:
+def parse_articles(paragraphs: Iterable[str]) -> List[Dict[str, Any]]:
     """
     Parse numbered article headings and their numbered paragraphs.
 
@@ -128,12 +144,13 @@ def parse_articles(paragraphs: List[str]) -> List[Dict[str, Any]]:
     """
     articles: List[Dict[str, Any]] = []
     current_article: Dict[str, Any] | None = None
-    current_para_text: str | None = None
+    # lines of the open paragraph, joined once when it is flushed
+    current_para_text: List[str] | None = None
 
     def flush_current_paragraph():
         nonlocal current_para_text
         if current_article is not None and current_para_text:
-            text = current_para_text.strip()
+            text = " ".join(current_para_text).strip()
             if text:
                 current_article["article paragraphs"].append(text)
         current_para_text = None
@@ -149,8 +166,13 @@ def parse_articles(paragraphs: List[str]) -> List[Dict[str, Any]]:
         if not line:
             continue
 
+        # Headings and numbered paragraphs all start with a digit or "(";
+        # the patterns are only run on such lines, not on continuation text
+        first = line[0]
+        candidate = first == "(" or first.isdecimal()
+
         # Possible heading?
-        m_head = HEADING_RE.match(line)
+        m_head = candidate and HEADING_RE.match(line)
         if m_head:
             article_id = m_head.group(1).strip()
             article_name = m_head.group(2).strip()
@@ -160,30 +182,32 @@ def parse_articles(paragraphs: List[str]) -> List[Dict[str, Any]]:
                 current_article = {
                     "article id": article_id,
                     "article name": article_name,
-                    "article paragraphs": []
+                    "article paragraphs": [],
+                    # set once the article has a numbered paragraph
+                    "_has_numbered": False,
                 }
                 current_para_text = None
                 continue  # go to next line
 
         # If we are inside an article, collect its paragraphs
         if current_article is not None:
-            m_para = PARA_START_RE.match(line)
+            m_para = candidate and PARA_START_RE.match(line)
             if m_para:
                 # New numbered paragraph "(n) ..."
                 flush_current_paragraph()
-                current_para_text = line
+                current_para_text = [line]
+                current_article["_has_numbered"] = True
             else:
                 # Continuation / unnumbered line
                 if current_para_text:
                     # append continuation to existing paragraph
-                    current_para_text += " " + line.strip()
+                    current_para_text.append(line.strip())
                 else:
                     # Only start an unnumbered paragraph if this article
                     # already has at least one numbered paragraph; this avoids
                     # turning pure ToC sections into "articles".
-                    if any(PARA_START_RE.match(p)
-                           for p in current_article["article paragraphs"]):
-                        current_para_text = line
+                    if current_article["_has_numbered"]:
+                        current_para_text = [line]
 
     # Flush last open article
     flush_current_article()
@@ -191,7 +215,7 @@ def parse_articles(paragraphs: List[str]) -> List[Dict[str, Any]]:
     # Final filter: keep only articles that contain at least one "(n) ..." paragraph
     filtered_articles: List[Dict[str, Any]] = []
     for a in articles:
-        if any(PARA_START_RE.match(p) for p in a["article paragraphs"]):
+        if a.pop("_has_numbered"):
             filtered_articles.append(a)
 
     return filtered_articles
@@ -203,13 +227,16 @@ def parse_articles(paragraphs: List[str]) -> List[Dict[str, Any]]:
 
 def parse_document(file_path: str) -> Dict[str, Any]:
     """Parse a single *.di.json document into the desired output structure."""
-    with open(file_path, "r", encoding="utf-8") as f:
-        doc = json.load(f)
-
-    paragraphs = load_paragraphs(doc)
-    document_title = guess_document_title(paragraphs)
+    # Decode straight from the mapped file, without reading it into a
+    # bytes copy first
+    with open(file_path, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            memoryview(mm) as view:
+        doc = orjson.loads(view)
+
+    document_title = guess_document_title(iter_paragraphs(doc))
     document_name = guess_document_name(file_path)
-    articles = parse_articles(paragraphs)
+    articles = parse_articles(iter_paragraphs(doc))
 
     return {
         "document title": document_title,
@@ -223,10 +250,14 @@ def parse_all_documents(pattern: str = "*.di.json") -> List[Dict[str, Any]]:
     Parse all documents matching the glob pattern (default: all *.di.json
     in the current directory) and return them as a list.
     """
+    paths = sorted(glob.glob(pattern))
+    # Documents are independent and parsing is CPU-bound, so parse them in
+    # separate processes; results come back in input order
     result: List[Dict[str, Any]] = []
-    for path in sorted(glob.glob(pattern)):
-        print(f"Parsing {path}...")
-        result.append(parse_document(path))
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+        for path, document in zip(paths, ex.map(parse_document, paths, chunksize=4)):
+            print(f"Parsed {path}")
+            result.append(document)
     return result
 
 
@@ -234,5 +265,5 @@ if __name__ == "__main__":
     # Adjust pattern if your files are elsewhere, e.g. "data/*.di.json"
     documents = parse_all_documents("*.di.json")
 
-    with open("all_documents_parsed.json", "w", encoding="utf-8") as out_f:
-        json.dump(documents, out_f, ensure_ascii=False, indent=4)
+    with open("all_documents_parsed.json", "wb") as out_f:
+        out_f.write(orjson.dumps(documents, option=orjson.OPT_INDENT_2))
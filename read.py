@@ -1,11 +1,36 @@
 #!/usr/bin/env python3
+import os
 import json
 import re
-import requests
+import shelve
+import asyncio
+import hashlib
+import itertools
+import httpx
+import numpy as np
+from sklearn.linear_model import LogisticRegression
 import csv
 from pathlib import Path
-
-from PyPDF2 import PdfReader  # pip install PyPDF2
+from tqdm import tqdm
+
+import pypdfium2 as pdfium  # pip install pypdfium2
+
+from local_llm import (
+    CONCURRENCY as SERVER_CONCURRENCY,
+    LLM_BACKEND,
+    MODEL_NAME as OLLAMA_MODEL,
+    SESSION,
+    VLLM_MODEL,
+    VLLM_URL,
+    num_ctx_for,
+    response_text,
+)
+
+try:
+    # Streams DOC_JSON page by page instead of loading the whole tree
+    import ijson
+except ImportError:
+    ijson = None
 
 # --- CONFIG ---------------------------------------------------------
 
@@ -14,8 +39,67 @@ DOC_JSON = "bofjunction_dataset/gold/output_simple/BRRD/CELEX_32014L0059_EN_TXT.
 OUTPUT_CSV = "paragraph_classification.csv"
 
 OLLAMA_BASE_URL = "http://127.0.0.1:11434"
-# OLLAMA_MODEL = "deepseek-r1:14b"  # change to your local model name
-OLLAMA_MODEL = "gemma3:4b"  # change to your local model name
+# Several Ollama servers, e.g. one per GPU, share the generations round-robin:
+#   for i in 0 1; do
+#     CUDA_VISIBLE_DEVICES=$i OLLAMA_HOST=127.0.0.1:$((11434 + i)) ollama serve &
+#   done
+#   OLLAMA_HOSTS=http://127.0.0.1:11434,http://127.0.0.1:11435 python read.py
+OLLAMA_HOSTS = [
+    host.strip().rstrip("/")
+    for host in os.environ.get("OLLAMA_HOSTS", OLLAMA_BASE_URL).split(",")
+    if host.strip()
+]
+# The model, num_ctx and LLM_BACKEND settings come from local_llm
+
+# Output tokens of a one-label answer (NON_REQUIREMENT is ~5); generation
+# also stops at the first character that can't be part of a label
+LABEL_TOKENS = 8
+LABEL_STOP = ["\n", " ", ".", ","]
+
+# Model that gave a label, for the cache keys
+MODEL_NAME = VLLM_MODEL if LLM_BACKEND == "vllm" else OLLAMA_MODEL
+
+# Max number of requests in flight at once: local_llm's CONCURRENCY is per
+# server, so with Ollama it is multiplied by len(OLLAMA_HOSTS)
+CONCURRENCY = SERVER_CONCURRENCY * (1 if LLM_BACKEND == "vllm" else len(OLLAMA_HOSTS))
+# Server of the next Ollama generation
+_ollama_hosts = itertools.cycle(OLLAMA_HOSTS)
+REQUEST_TIMEOUT = 120
+
+# Persistent cache of paragraph labels, so re-runs skip the LLM
+CACHE_PATH = "requirement_cache.db"
+# Text extracted from GUIDELINES_PDF, reused while the PDF's mtime and size
+# (stored in the .meta file next to it) are unchanged
+GUIDELINES_CACHE = ".guidelines_cache.txt"
+# Optional second cache tier (SEMANTIC_CACHE=1): paragraphs are embedded
+# with EMBED_MODEL (ollama pull nomic-embed-text), and one whose cosine with
+# an already labelled paragraph is above SEMANTIC_THRESHOLD reuses its label
+SEMANTIC_CACHE = os.environ.get("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_THRESHOLD = 0.97
+# Where paragraphs are embedded:
+#   "ollama"                - Ollama's /api/embed, EMBED_BATCH_SIZE texts per
+#                             request, the requests sent concurrently
+#   "sentence-transformers" - in this process (pip install
+#                             sentence-transformers), one batched encode
+EMBED_BACKEND = os.environ.get("EMBED_BACKEND", "ollama")
+EMBED_URL = f"{OLLAMA_BASE_URL}/api/embed"
+EMBED_MODEL = (
+    "all-MiniLM-L6-v2" if EMBED_BACKEND == "sentence-transformers" else "nomic-embed-text"
+)
+EMBED_BATCH_SIZE = 64
+# Cache entries holding the embedding of a labelled paragraph
+EMBEDDING_PREFIX = f"embedding:{EMBED_MODEL}:"
+# Optional classifier (EMBED_CLASSIFIER=1): the LLM labels the first
+# SEED_SIZE paragraphs that need it, a logistic regression on their
+# EMBED_MODEL embeddings labels the others, and only those it is less than
+# CLASSIFIER_MIN_PROBA sure about still go to the LLM
+EMBED_CLASSIFIER = os.environ.get("EMBED_CLASSIFIER", "0") == "1"
+SEED_SIZE = 200
+CLASSIFIER_MIN_PROBA = 0.75
+# The classifier's labels are cached apart from the LLM's (this prefix plus
+# the paragraph_key), without embeddings, and only read back with
+# EMBED_CLASSIFIER on, so they never pass for LLM labels
+CLASSIFIER_PREFIX = "classifier:"
 
 # Define your 4 categories here
 CATEGORIES = [
@@ -25,6 +109,8 @@ CATEGORIES = [
     "CREDIT_RISK",
     "OTHER",  # for paragraphs not related to any of the above
 ]
+# First category named in a free-form answer (the 4-category classifier below)
+LABEL_RX = re.compile(r"\b(" + "|".join(map(re.escape, CATEGORIES)) + r")\b")
 
 
 # --- HELPERS --------------------------------------------------------
@@ -33,19 +119,72 @@ CATEGORIES = [
 def extract_guidelines_from_pdf(pdf_path: str) -> str:
     """Extract all text from the guidelines PDF."""
     pdf_path = Path(pdf_path)
-    reader = PdfReader(str(pdf_path))
-    pages_text = []
-    for page in reader.pages:
-        text = page.extract_text() or ""
-        pages_text.append(text)
-    return "\n\n".join(pages_text)
+    # PDFium (C++) extracts text much faster than a pure-Python parser
+    pdf = pdfium.PdfDocument(str(pdf_path))
+    try:
+        pages_text = []
+        for page in pdf:
+            text = page.get_textpage().get_text_range()
+            # PDFium ends lines with \r\n and marks a hyphen at a line
+            # break as U+FFFE
+            pages_text.append(text.replace("\r\n", "\n").replace("\ufffe", "-"))
+        return "\n\n".join(pages_text)
+    finally:
+        pdf.close()
+
+
+def load_guidelines(pdf_path: str, cache_path: str = GUIDELINES_CACHE) -> str:
+    """
+    extract_guidelines_from_pdf, cached in cache_path until the PDF changes.
+    """
+    stat = Path(pdf_path).stat()
+    # the extractor is part of the key, so switching it re-extracts
+    key = f"pdfium:{stat.st_mtime}:{stat.st_size}"
+    cache_file = Path(cache_path)
+    meta_file = Path(cache_path + ".meta")
+    if cache_file.exists() and meta_file.exists():
+        if meta_file.read_text(encoding="utf-8") == key:
+            return cache_file.read_text(encoding="utf-8")
+
+    text = extract_guidelines_from_pdf(pdf_path)
+    cache_file.write_text(text, encoding="utf-8")
+    # written last, so an interrupted write is never taken for a valid cache
+    meta_file.write_text(key, encoding="utf-8")
+    return text
 
 import json
 from pathlib import Path
 
+def iter_page_paragraphs(page: dict):
+    """The non-empty paragraph strings of one page."""
+    # Be tolerant: skip pages that don't have paragraphs
+    para_list = page.get("paragraphs", [])
+    for para in para_list:
+        # Case 1: paragraph is already a string
+        if isinstance(para, str):
+            text = para.strip()
+            if text:
+                yield text
+
+        # Case 2: paragraph is an object with a "text" field
+        elif isinstance(para, dict):
+            # Try 'text' first, then fall back to other common keys
+            text = (
+                para.get("text")
+                or para.get("content")
+                or para.get("para")
+            )
+            if isinstance(text, str):
+                text = text.strip()
+                if text:
+                    yield text
+
+        # If there's some other weird structure, ignore it silently
+
+
 def load_paragraphs_from_json(json_path: str):
     """
-    Load a JSON document and return a list of paragraph strings.
+    Load a JSON document and yield its paragraph strings.
 
     Expected structure (as you described):
         {
@@ -62,47 +201,33 @@ def load_paragraphs_from_json(json_path: str):
     Each element in "paragraphs" can be either:
       - a plain string
       - or an object with a "text" field (and maybe other metadata)
+
+    With ijson installed the pages are parsed one at a time, so memory use
+    doesn't depend on the document size.
     """
     json_path = Path(json_path)
-    with json_path.open("r", encoding="utf-8") as f:
+    with json_path.open("rb") as f:
+        if ijson is not None:
+            pages = ijson.items(f, "pages.item")
+            if next(pages, None) is not None:  # XXX first page skipped
+                for page in pages:
+                    yield from iter_page_paragraphs(page)
+                return
+            # no pages: load it whole to tell an empty "pages" from a
+            # different format
+            f.seek(0)
         data = json.load(f)
 
-    paragraphs = []
-
     if isinstance(data, dict) and "pages" in data:
         for page in data["pages"][1:]: # XXX
-            # Be tolerant: skip pages that don't have paragraphs
-            para_list = page.get("paragraphs", [])
-            for para in para_list:
-                # Case 1: paragraph is already a string
-                if isinstance(para, str):
-                    text = para.strip()
-                    if text:
-                        paragraphs.append(text)
-
-                # Case 2: paragraph is an object with a "text" field
-                elif isinstance(para, dict):
-                    # Try 'text' first, then fall back to other common keys
-                    text = (
-                        para.get("text")
-                        or para.get("content")
-                        or para.get("para")
-                    )
-                    if isinstance(text, str):
-                        text = text.strip()
-                        if text:
-                            paragraphs.append(text)
-
-                # If there's some other weird structure, ignore it silently
+            yield from iter_page_paragraphs(page)
     else:
         # Fallback: if the format is totally different, just dump and don't crash
         print("Warning: JSON structure not as expected (no 'pages' key).")
         text = json.dumps(data, ensure_ascii=False)
         text = text.strip()
         if text:
-            paragraphs.append(text)
-
-    return paragraphs
+            yield text
 
 # def classify_paragraph_with_ollama(paragraph: str, guidelines: str = "") -> str:
 #     """
@@ -251,55 +376,134 @@ def load_paragraphs_from_json(json_path: str):
 #     # --- Post-process to enforce a single clean label -----------------
 #     normalized = content.upper().strip()
 
-#     # 1) Exact match
-#     for cat in CATEGORIES:
-#         if normalized == cat:
-#             return cat
+#     # Exact match, first token (e.g. "CREDIT_RISK because ...") or
+#     # category mentioned anywhere: the leftmost category in the answer.
+#     # If it really went off the rails, treat as OTHER
+#     m = LABEL_RX.search(normalized)
+#     return m.group(1) if m else "OTHER"
+REQUIREMENT_LABELS = ("REQUIREMENT", "NON_REQUIREMENT")
 
-#     # 2) First token (e.g. "CREDIT_RISK because ...")
-#     first_token = re.split(r"\s+|\n+", normalized)[0]
-#     for cat in CATEGORIES:
-#         if first_token == cat:
-#             return cat
-
-#     # 3) Category mentioned anywhere
-#     for cat in CATEGORIES:
-#         if re.search(rf"\b{re.escape(cat)}\b", normalized):
-#             return cat
-
-#     # 4) If it really went off the rails, treat as OTHER
-#     return "OTHER"
-def classify_paragraph_with_ollama(paragraph: str, guidelines: str = "") -> str:
+LABEL_DEFINITIONS = """
+REQUIREMENT = contains an obligation (e.g., "shall", "must", "should ensure", "are required to").
+NON_REQUIREMENT = background, explanation, recitals, context, headings, or anything not imposing an action.
+""".strip()
+
+# Deterministic pre-filter: a short paragraph with none of the obligation
+# wordings in LABEL_DEFINITIONS (headings, titles, references, ...) is
+# NON_REQUIREMENT without asking the LLM. Anything longer or containing one
+# of them is left to the model
+REQ_RX = re.compile(
+    r"\b(shall|must|are required to|should ensure|is obliged to|may not)\b", re.I
+)
+PREFILTER_MAX_LEN = 200
+
+# Paragraphs classified together in one prompt, so the instructions are
+# only sent once per group instead of once per paragraph
+PARAGRAPHS_PER_PROMPT = 8
+# Structured output for a group: one label per paragraph, in order
+LABEL_LIST_FORMAT = {
+    "type": "object",
+    "properties": {
+        "labels": {
+            "type": "array",
+            "items": {"type": "string", "enum": list(REQUIREMENT_LABELS)},
+        },
+    },
+    "required": ["labels"],
+}
+
+
+def build_classify_prompt(paragraph: str) -> str:
     """
-    Classify paragraph into REQUIREMENT or NON_REQUIREMENT.
+    Prompt that classifies paragraph into REQUIREMENT or NON_REQUIREMENT.
     Optimized for small 4B models (Gemma).
     """
 
-    system_prompt = """
-Classify the paragraph as one label:
+    system_prompt = (
+        "Classify the paragraph as one label:\n\n"
+        + LABEL_DEFINITIONS
+        + "\n\nReturn ONLY one label: REQUIREMENT or NON_REQUIREMENT."
+    )
 
-REQUIREMENT = contains an obligation (e.g., "shall", "must", "should ensure", "are required to").
-NON_REQUIREMENT = background, explanation, recitals, context, headings, or anything not imposing an action.
+    user_prompt = f'Paragraph:\n"""{paragraph}"""\nLabel?'
 
-Return ONLY one label: REQUIREMENT or NON_REQUIREMENT.
-    """.strip()
+    return system_prompt + "\n\n" + user_prompt
 
-    user_prompt = f'Paragraph:\n"""{paragraph}"""\nLabel?'
 
-    full_prompt = system_prompt + "\n\n" + user_prompt
+def build_batch_prompt(paragraphs: list) -> str:
+    """
+    Prompt that classifies several paragraphs at once; the answer is
+    constrained to LABEL_LIST_FORMAT.
+    """
+    system_prompt = (
+        "Classify each paragraph below as one label:\n\n"
+        + LABEL_DEFINITIONS
+        + '\n\nReturn JSON {"labels": [...]} with one label, REQUIREMENT or '
+        f"NON_REQUIREMENT, for each of the {len(paragraphs)} paragraphs, in order."
+    )
+    user_prompt = "\n\n".join(
+        f'Paragraph {n}:\n"""{paragraph}"""'
+        for n, paragraph in enumerate(paragraphs, start=1)
+    )
+    return system_prompt + "\n\n" + user_prompt
+
+
+def build_request(prompt: str, choices=None, schema=None) -> tuple:
+    """
+    (url, payload) of one generation on LLM_BACKEND. vLLM can constrain the
+    answer to one of `choices`; both backends can constrain it to the JSON
+    `schema`.
+    """
+    if LLM_BACKEND == "vllm":
+        payload = {
+            "model": VLLM_MODEL,
+            "messages": [{"role": "user", "content": prompt}],
+        }
+        if choices is not None:
+            payload["guided_choice"] = list(choices)
+        if schema is not None:
+            payload["guided_json"] = schema
+        return VLLM_URL, payload
 
-    url = f"{OLLAMA_BASE_URL}/api/generate"
     payload = {
         "model": OLLAMA_MODEL,
-        "prompt": full_prompt,
+        "prompt": prompt,
         "stream": False,
+        "options": {"num_ctx": num_ctx_for(prompt), "temperature": 0},
     }
-
-    resp = requests.post(url, json=payload)
+    if choices is not None:
+        payload["options"].update(num_predict=LABEL_TOKENS, stop=LABEL_STOP)
+    if schema is not None:
+        payload["format"] = schema
+    return f"{next(_ollama_hosts)}/api/generate", payload
+
+
+async def generate_async(
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    prompt: str,
+    choices=None,
+    schema=None,
+) -> str:
+    """
+    Raw answer to prompt from LLM_BACKEND. The semaphore caps the number of
+    requests in flight at what the server serves in parallel.
+    """
+    url, payload = build_request(prompt, choices, schema)
+    async with sem:
+        resp = await client.post(url, json=payload)
     resp.raise_for_status()
-    data = resp.json()
+    return response_text(resp.json())
+
 
-    raw = data.get("response", "") or ""
+def prefilter_label(paragraph: str):
+    """Label of a paragraph that needs no LLM call, or None."""
+    if len(paragraph) < PREFILTER_MAX_LEN and not REQ_RX.search(paragraph):
+        return "NON_REQUIREMENT"
+    return None
+
+
+def parse_requirement_label(raw: str) -> str:
     text = raw.strip().upper()
 
     # Clean output
@@ -310,22 +514,306 @@ Return ONLY one label: REQUIREMENT or NON_REQUIREMENT.
 
     # Fallback: small models guess "requirement" too often → be conservative
     return "NON_REQUIREMENT"
+
+
+def parse_batch_labels(raw: str, n: int) -> list:
+    """
+    The n labels of a batch answer; ValueError if it doesn't fit.
+    """
+    try:
+        labels = json.loads(raw)["labels"]
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Unexpected batch answer: {raw!r}") from e
+    if not isinstance(labels, list) or len(labels) != n:
+        raise ValueError(f"Expected {n} labels, got {labels!r}")
+    labels = [str(label).strip().upper() for label in labels]
+    if any(label not in REQUIREMENT_LABELS for label in labels):
+        raise ValueError(f"Unexpected labels: {labels!r}")
+    return labels
+
+
+def classify_paragraph_with_ollama(paragraph: str, guidelines: str = "") -> str:
+    """
+    Classify paragraph into REQUIREMENT or NON_REQUIREMENT (on LLM_BACKEND,
+    despite the name).
+    """
+    url, payload = build_request(
+        build_classify_prompt(paragraph), choices=REQUIREMENT_LABELS
+    )
+    resp = SESSION.post(url, json=payload, timeout=REQUEST_TIMEOUT)
+    resp.raise_for_status()
+    return parse_requirement_label(response_text(resp.json()))
+
+
+async def classify_paragraph_async(
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    paragraph: str,
+    guidelines: str = "",
+) -> str:
+    """
+    Async version of classify_paragraph_with_ollama.
+    """
+    raw = await generate_async(
+        client, sem, build_classify_prompt(paragraph), choices=REQUIREMENT_LABELS
+    )
+    return parse_requirement_label(raw)
+
+
+async def classify_batch_async(
+    client: httpx.AsyncClient, sem: asyncio.Semaphore, paragraphs: list
+) -> list:
+    """
+    Labels for a list of paragraphs from a single request. Falls back to one
+    request per paragraph if the answer doesn't fit.
+    """
+    if len(paragraphs) == 1:
+        return [await classify_paragraph_async(client, sem, paragraphs[0])]
+    raw = await generate_async(
+        client, sem, build_batch_prompt(paragraphs), schema=LABEL_LIST_FORMAT
+    )
+    try:
+        return parse_batch_labels(raw, len(paragraphs))
+    except ValueError:
+        return list(await asyncio.gather(*[
+            classify_paragraph_async(client, sem, paragraph) for paragraph in paragraphs
+        ]))
+
+
+def paragraph_key(paragraph: str) -> str:
+    """
+    Cache key of a paragraph; labels of different models are kept apart.
+    """
+    return f"{MODEL_NAME}:" + hashlib.sha256(paragraph.encode("utf-8")).hexdigest()
+
+
+_SENTENCE_MODEL = None
+
+
+def get_sentence_model():
+    """
+    Lazily load EMBED_MODEL (only needed for EMBED_BACKEND=sentence-transformers).
+    """
+    global _SENTENCE_MODEL
+    if _SENTENCE_MODEL is None:
+        from sentence_transformers import SentenceTransformer
+
+        _SENTENCE_MODEL = SentenceTransformer(EMBED_MODEL)
+    return _SENTENCE_MODEL
+
+
+async def embed_texts(client: httpx.AsyncClient, texts: list) -> np.ndarray:
+    """
+    L2-normalised embeddings of texts as a (len(texts), dim) array, on
+    EMBED_BACKEND.
+    """
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+
+    if EMBED_BACKEND == "sentence-transformers":
+        # in a thread, so the LLM requests in flight keep going meanwhile
+        embeddings = await asyncio.to_thread(
+            get_sentence_model().encode,
+            texts,
+            batch_size=EMBED_BATCH_SIZE,
+            convert_to_numpy=True,
+        )
+        embeddings = embeddings.astype(np.float32)
+    else:
+        async def embed_batch(batch):
+            resp = await client.post(EMBED_URL, json={"model": EMBED_MODEL, "input": batch})
+            resp.raise_for_status()
+            return resp.json()["embeddings"]
+
+        batches = await asyncio.gather(*[
+            embed_batch(texts[start : start + EMBED_BATCH_SIZE])
+            for start in range(0, len(texts), EMBED_BATCH_SIZE)
+        ])
+        embeddings = np.asarray(
+            [vector for batch in batches for vector in batch], dtype=np.float32
+        )
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+async def near_duplicates(client: httpx.AsyncClient, cache, todo: dict):
+    """
+    Match the paragraphs in todo ({key: paragraph}) against the labelled
+    paragraphs in the cache and against each other, by embedding cosine.
+
+    Returns (same_as, embeddings): same_as maps the key of every paragraph
+    above SEMANTIC_THRESHOLD to the key whose label it reuses; embeddings
+    holds the vectors of the remaining ones, which still need the LLM.
+    """
+    ref_keys = [
+        k[len(EMBEDDING_PREFIX):] for k in cache.keys() if k.startswith(EMBEDDING_PREFIX)
+    ]
+    ref_keys = [k for k in ref_keys if k in cache]
+    vectors = await embed_texts(client, list(todo.values()))
+
+    refs = np.empty((len(ref_keys) + len(todo), vectors.shape[1]), dtype=np.float32)
+    for n, k in enumerate(ref_keys):
+        refs[n] = cache[EMBEDDING_PREFIX + k]
+
+    same_as = {}
+    embeddings = {}
+    n_refs = len(ref_keys)
+    for key, vector in zip(todo, vectors):
+        if n_refs:
+            sims = refs[:n_refs] @ vector
+            best = int(sims.argmax())
+            if sims[best] >= SEMANTIC_THRESHOLD:
+                same_as[key] = ref_keys[best]
+                continue
+        # a new reference: later near-duplicates in this run reuse its label
+        refs[n_refs] = vector
+        ref_keys.append(key)
+        n_refs += 1
+        embeddings[key] = vector
+    return same_as, embeddings
+
+
+def confident_labels(seed_vectors: np.ndarray, seed_labels: list, vectors: np.ndarray) -> list:
+    """
+    Label of every row of vectors, predicted by a logistic regression fitted
+    on the seed, or None where its probability is below CLASSIFIER_MIN_PROBA.
+    """
+    if len(set(seed_labels)) < 2:
+        # a one-label seed gives nothing to tell apart
+        return [None] * len(vectors)
+    model = LogisticRegression(max_iter=1000).fit(seed_vectors, seed_labels)
+    proba = model.predict_proba(vectors)
+    best = proba.argmax(axis=1)
+    return [
+        str(model.classes_[b]) if proba[n, b] >= CLASSIFIER_MIN_PROBA else None
+        for n, b in enumerate(best)
+    ]
+
+
+async def classify_paragraphs(
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    cache,
+    paragraphs: list,
+    guidelines: str = "",
+) -> list:
+    """
+    Label of every paragraph, in order. Obvious NON_REQUIREMENTs are labelled
+    by prefilter_label, the others come from the cache by exact paragraph
+    hash, then (with SEMANTIC_CACHE) from a near-duplicate, then (with
+    EMBED_CLASSIFIER) from a classifier trained on the first LLM labels, and
+    only the rest is sent to the LLM, once per distinct paragraph and in
+    groups of PARAGRAPHS_PER_PROMPT per request.
+    """
+    keys = [paragraph_key(p) for p in paragraphs]
+    labels = {}
+    for paragraph, key in zip(paragraphs, keys):
+        label = prefilter_label(paragraph)
+        if label is not None:
+            labels[key] = label
+    labels.update({k: cache[k] for k in set(keys) - labels.keys() if k in cache})
+    if EMBED_CLASSIFIER:
+        labels.update({
+            k: cache[CLASSIFIER_PREFIX + k]
+            for k in set(keys) - labels.keys()
+            if CLASSIFIER_PREFIX + k in cache
+        })
+    todo = {}  # key -> paragraph, first occurrence of every key to classify
+    for paragraph, key in zip(paragraphs, keys):
+        if key not in labels:
+            todo.setdefault(key, paragraph)
+
+    same_as, embeddings = {}, {}
+    if SEMANTIC_CACHE and todo:
+        same_as, embeddings = await near_duplicates(client, cache, todo)
+        for key in same_as:
+            del todo[key]
+
+    async def classify(group, progress):
+        # cached as soon as known, so an interrupted run keeps its labels
+        group_labels = await classify_batch_async(
+            client, sem, [todo[key] for key in group]
+        )
+        for key, label in zip(group, group_labels):
+            labels[key] = cache[key] = label
+            if key in embeddings:
+                cache[EMBEDDING_PREFIX + key] = embeddings[key]
+        progress.update(len(group))
+
+    keys_todo = list(todo)
+    guessed = set()  # keys labelled by the classifier
+    with tqdm(total=len(keys_todo), desc="LLM", unit="paragraph") as progress:
+        if EMBED_CLASSIFIER and len(keys_todo) > SEED_SIZE:
+            vectors = {k: embeddings[k] for k in keys_todo if k in embeddings}
+            missing = [k for k in keys_todo if k not in vectors]
+            if missing:
+                vectors.update(zip(missing, await embed_texts(
+                    client, [todo[k] for k in missing]
+                )))
+
+            seed, keys_todo = keys_todo[:SEED_SIZE], keys_todo[SEED_SIZE:]
+            await asyncio.gather(*[
+                classify(seed[start : start + PARAGRAPHS_PER_PROMPT], progress)
+                for start in range(0, len(seed), PARAGRAPHS_PER_PROMPT)
+            ])
+            predicted = confident_labels(
+                np.stack([vectors[k] for k in seed]),
+                [labels[k] for k in seed],
+                np.stack([vectors[k] for k in keys_todo]),
+            )
+            unsure = []
+            for key, label in zip(keys_todo, predicted):
+                if label is None:
+                    unsure.append(key)
+                    continue
+                labels[key] = cache[CLASSIFIER_PREFIX + key] = label
+                guessed.add(key)
+            progress.update(len(keys_todo) - len(unsure))
+            keys_todo = unsure
+
+        await asyncio.gather(*[
+            classify(keys_todo[start : start + PARAGRAPHS_PER_PROMPT], progress)
+            for start in range(0, len(keys_todo), PARAGRAPHS_PER_PROMPT)
+        ])
+    for key, ref in same_as.items():
+        if ref in guessed:
+            labels[key] = cache[CLASSIFIER_PREFIX + key] = labels[ref]
+        else:
+            labels[key] = cache[key] = labels.get(ref) or cache[ref]
+    return [labels[k] for k in keys]
 # --- MAIN SCRIPT ----------------------------------------------------
 
 
-def main():
+async def main():
     print("Extracting guidelines from PDF...")
-    guidelines_text = extract_guidelines_from_pdf(GUIDELINES_PDF)
+    guidelines_text = load_guidelines(GUIDELINES_PDF)
 
     print("Loading paragraphs from JSON...")
-    paragraphs = load_paragraphs_from_json(DOC_JSON)
-    print(f"Found {len(paragraphs)} paragraphs.")
+    # Repeated boilerplate (headers, recitals) is classified once: order[i]
+    # is the index of the i-th paragraph among the distinct paragraphs
+    unique = {}
+    order = []
+    for para in load_paragraphs_from_json(DOC_JSON):
+        order.append(unique.setdefault(para, len(unique)))
+    distinct = list(unique)
+    print(f"Found {len(order)} paragraphs.")
+
+    # All uncached paragraphs are sent at once; the semaphore keeps
+    # CONCURRENCY of them in flight
+    print(f"Classifying {len(distinct)} distinct paragraphs...")
+    sem = asyncio.Semaphore(CONCURRENCY)
+    limits = httpx.Limits(
+        max_connections=CONCURRENCY, max_keepalive_connections=CONCURRENCY
+    )
+    with shelve.open(CACHE_PATH) as cache:
+        async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT, limits=limits) as client:
+            labels_u = await classify_paragraphs(
+                client, sem, cache, distinct, guidelines_text
+            )
 
     rows = []
-    for idx, para in enumerate(paragraphs, start=1):
-        print(f"Classifying paragraph {idx}/{len(paragraphs)}...")
-        category = classify_paragraph_with_ollama(para, guidelines_text)
-        print(idx, category, para)
+    for idx, i in enumerate(order, start=1):
+        para, category = distinct[i], labels_u[i]
         rows.append({
             "paragraph_index": idx,
             "category": category,
@@ -342,4 +830,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
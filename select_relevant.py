@@ -1,42 +1,54 @@
-import json
-import subprocess
+import gc
+import orjson
+import asyncio
+import httpx
+from tqdm import tqdm
 from typing import List, Dict, Any
 
+from local_llm import (
+    CONCURRENCY, make_async_client, map_in_order, query_llm, query_llm_async,
+)
 
-# ---------------------------------------------------------
-# 1. Query Ollama locally (model: qwen3:4b)
-# ---------------------------------------------------------
+# The answer is YES or NO: stop at the first token after it
+LABEL_TOKENS = 4
+LABEL_STOP = ["\n", " ", ".", ","]
 
-def query_llm(prompt: str) -> str:
-    """Calls Ollama locally with model gemma3:4b."""
-    process = subprocess.Popen(
-        ["ollama", "run", "gemma3:4b"],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True
-    )
-    out, err = process.communicate(prompt)
-    if err:
-        print("LLM error:", err)
-    return out.strip()
+# Run the garbage collector after this many articles have been written out
+GC_EVERY = 100
 
 
 # ---------------------------------------------------------
-# 2. Classification helper
+# 1. Classification helper
 # ---------------------------------------------------------
 
+# Sent as the system message, the article as the user message
+RELEVANCE_PROMPT = (
+    "answer only YES or NO. "
+    "Is this legislation relevant for organizations giving credit:"
+)
+
+
 def is_credit_relevant(article_paragraphs: List[str]) -> bool:
     """Builds prompt and interprets YES/NO model output."""
-    article_text = "\n".join(article_paragraphs)
+    raw = query_llm(
+        "\n".join(article_paragraphs), RELEVANCE_PROMPT,
+        max_tokens=LABEL_TOKENS, stop=LABEL_STOP,
+    )
+    return parse_yes_no(raw)
 
-    prompt = (
-        "answer only YES or NO. "
-        "Is this legislation relevant for organizations giving credit: "
-        f"{article_text}"
+
+async def is_credit_relevant_async(
+    client: httpx.AsyncClient, sem: asyncio.Semaphore, article_paragraphs: List[str]
+) -> bool:
+    """Async version of is_credit_relevant."""
+    raw = await query_llm_async(
+        client, sem, "\n".join(article_paragraphs), RELEVANCE_PROMPT,
+        max_tokens=LABEL_TOKENS, stop=LABEL_STOP,
     )
+    return parse_yes_no(raw)
+
 
-    raw = query_llm(prompt)
+def parse_yes_no(raw: str) -> bool:
     answer = raw.strip().upper()
 
     if answer.startswith("YES"):
@@ -47,71 +59,109 @@ def is_credit_relevant(article_paragraphs: List[str]) -> bool:
 
 
 # ---------------------------------------------------------
-# 3. Main classification function with PROGRESS PRINTING
+# 2. Main classification function with PROGRESS PRINTING
 # ---------------------------------------------------------
 
 def classify_articles(
     input_json: str = "eba_parsed.json",
-    output_relevant: str = "credit_related_eba.json",
-    output_unrelated: str = "unrelated_eba.json",
+    output_relevant: str = "credit_related_eba.jsonl",
+    output_unrelated: str = "unrelated_eba.jsonl",
 ) -> None:
+    """
+    Blocking wrapper around classify_articles_async for CLI use.
 
-    # Load parsed documents
-    with open(input_json, "r", encoding="utf-8") as f:
-        documents: List[Dict[str, Any]] = json.load(f)
-
-    total_docs = len(documents)
-    relevant_articles = []
-    unrelated_articles = []
+    Both outputs are JSONL: one article record per line, in input order,
+    written as soon as the article and the ones before it are classified, so
+    memory use doesn't grow with the output. Articles whose request failed
+    are reported and left out of both.
+    """
+    asyncio.run(classify_articles_async(input_json, output_relevant, output_unrelated))
 
-    print(f"Total documents to process: {total_docs}\n")
 
-    for doc_index, doc in enumerate(documents, start=1):
-        doc_title = doc.get("document title", "")
-        doc_name = doc.get("document name", "")
-        articles = doc.get("articles", [])
-        total_articles = len(articles)
-
-        print(f"Processing document {doc_index}/{total_docs}: {doc_name} "
-              f"({total_articles} articles)")
-
-        for art_index, article in enumerate(articles, start=1):
-            paragraphs = article.get("article paragraphs", [])
-            if not paragraphs:
-                continue
-
-            # classify with LLM
-            is_rel = is_credit_relevant(paragraphs)
-            print(is_rel)
-            record = {
-                "document title": doc_title,
-                "document name": doc_name,
-                "article id": article.get("article id"),
-                "article name": article.get("article name"),
-                "article paragraphs": paragraphs,
-            }
-
-            if is_rel:
-                relevant_articles.append(record)
-            else:
-                unrelated_articles.append(record)
-
-            print(f"  Article {art_index}/{total_articles} classified")
+async def classify_articles_async(
+    input_json: str = "eba_parsed.json",
+    output_relevant: str = "credit_related_eba.jsonl",
+    output_unrelated: str = "unrelated_eba.jsonl",
+) -> None:
 
-        print("")  # spacing between documents
+    # Load parsed documents
+    with open(input_json, "rb") as f:
+        documents: List[Dict[str, Any]] = orjson.loads(f.read())
 
-    # Save output files
-    with open(output_relevant, "w", encoding="utf-8") as f:
-        json.dump(relevant_articles, f, ensure_ascii=False, indent=4)
+    total_docs = len(documents)
+    total_articles = sum(
+        1
+        for doc in documents
+        for article in doc.get("articles", [])
+        if article.get("article paragraphs")
+    )
+    relevant_count = 0
+    unrelated_count = 0
+    failed_count = 0
+    written = 0
 
-    with open(output_unrelated, "w", encoding="utf-8") as f:
-        json.dump(unrelated_articles, f, ensure_ascii=False, indent=4)
+    print(f"Total documents to process: {total_docs}\n")
 
-    print("Processing completed!")
+    def article_records():
+        for doc_index in range(total_docs):
+            doc = documents[doc_index]
+            # Drop the document from the input list once its articles are queued
+            documents[doc_index] = None
+            doc_title = doc.get("document title", "")
+            doc_name = doc.get("document name", "")
+            for article in doc.get("articles", []):
+                paragraphs = article.get("article paragraphs", [])
+                if paragraphs:
+                    yield {
+                        "document title": doc_title,
+                        "document name": doc_name,
+                        "article id": article.get("article id"),
+                        "article name": article.get("article name"),
+                        "article paragraphs": paragraphs,
+                    }
+
+    # The articles are classified concurrently (at most CONCURRENCY at a
+    # time), and each one is written out as soon as it and the ones before
+    # it are done, so the outputs keep the input order
+    sem = asyncio.Semaphore(CONCURRENCY)
+    async with make_async_client() as client:
+        with open(output_relevant, "wb") as relevant_out, \
+                open(output_unrelated, "wb") as unrelated_out, \
+                tqdm(total=total_articles, desc="LLM", unit="article") as progress:
+            async for record, is_rel in map_in_order(
+                lambda record: is_credit_relevant_async(
+                    client, sem, record["article paragraphs"]
+                ),
+                article_records(),
+            ):
+                progress.update()
+                if isinstance(is_rel, Exception):
+                    progress.write(
+                        f"  [WARN] Article {record['article id']} of "
+                        f"{record['document name']} failed: {is_rel!r}"
+                    )
+                    failed_count += 1
+                    continue
+
+                line = orjson.dumps(record) + b"\n"
+                if is_rel:
+                    relevant_out.write(line)
+                    relevant_count += 1
+                else:
+                    unrelated_out.write(line)
+                    unrelated_count += 1
+
+                written += 1
+                if written % GC_EVERY == 0:
+                    gc.collect()
+
+    print("\nProcessing completed!")
     print(f"Relevant articles saved to: {output_relevant}")
     print(f"Unrelated articles saved to: {output_unrelated}")
-    print(f"Total relevant: {len(relevant_articles)}")
-    print(f"Total unrelated: {len(unrelated_articles)}")
+    print(f"Total relevant: {relevant_count}")
+    print(f"Total unrelated: {unrelated_count}")
+    if failed_count:
+        print(f"Failed (in neither output): {failed_count}")
 
 
 if __name__ == "__main__":
@@ -1,33 +1,29 @@
-import json
-import subprocess
-from typing import List, Dict, Any, Optional
+import gc
+import re
+import orjson
+import asyncio
+import httpx
+from tqdm import tqdm
+from contextlib import ExitStack
+from typing import List, Dict, Any, AsyncIterable, Optional, Tuple
+
+from article_io import load_articles
+from local_llm import (
+    CONCURRENCY, make_async_client, map_in_order, query_llm, query_llm_async,
+)
+
+# Output tokens of a one-label answer, enough for "5. COMPLIANCE_RISK".
+# Generation stops at the end of the line; not at " " or ".", which the
+# numbered answers parse_category accepts contain
+LABEL_TOKENS = 8
+LABEL_STOP = ["\n"]
+
+# Run the garbage collector after this many articles have been written out
+GC_EVERY = 100
 
 
 # ---------------------------------------------------------
-# 1. Query Ollama locally (model: gemma3:4b)
-# ---------------------------------------------------------
-
-
-def query_llm(prompt: str) -> str:
-    """
-    Calls Ollama locally with model gemma3:4b.
-    Returns the raw model output as a string.
-    """
-    process = subprocess.Popen(
-        ["ollama", "run", "gemma3:4b"],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-    )
-    out, err = process.communicate(prompt)
-    if err:
-        print("LLM error:", err)
-    return out.strip()
-
-
-# ---------------------------------------------------------
-# 2. Map LLM output to one of the 5 categories
+# 1. Map LLM output to one of the 5 categories
 # ---------------------------------------------------------
 
 VALID_CATEGORIES = {
@@ -37,6 +33,49 @@ VALID_CATEGORIES = {
     "OPERATIONAL_RISK",
     "COMPLIANCE_RISK",
 }
+# Any category name in an answer; no name contains another, so the leftmost
+# match is the category the answer starts with
+CATEGORY_RX = re.compile("|".join(sorted(VALID_CATEGORIES)))
+
+
+CATEGORY_DEFINITIONS = (
+    "1. CREDIT_RISK — Risk of financial loss arising when borrowers or "
+    "counterparties fail to meet their contractual obligations.\n\n"
+    "2. LIQUIDITY_RISK — Risk that the institution cannot meet cash or "
+    "collateral demands without incurring unacceptable costs or losses.\n\n"
+    "3. MARKET_RISK — Risk of loss from adverse movements in market "
+    "variables such as interest rates, currencies, or credit spreads.\n\n"
+    "4. OPERATIONAL_RISK — Risk of loss resulting from failures in internal "
+    "processes, people, systems, or from external disruptions or cyber events.\n\n"
+    "5. COMPLIANCE_RISK — Risk of legal, regulatory, or conduct breaches "
+    "leading to penalties, restrictions, or reputational harm.\n\n"
+)
+
+# Structured answer of the single-pass classification (relevance + category)
+COMBINED_FORMAT = {
+    "type": "object",
+    "properties": {
+        "relevant": {"type": "boolean"},
+        "category": {"type": "string", "enum": sorted(VALID_CATEGORIES)},
+    },
+    "required": ["relevant", "category"],
+}
+
+
+# System messages; the article text is the user message. They are the same
+# for every article, so the server computes them once
+CATEGORY_PROMPT = (
+    "Which of the following categories is this legistlation related to. "
+    "answer only the name of the category\n\n"
+    + CATEGORY_DEFINITIONS.rstrip()
+)
+COMBINED_PROMPT = (
+    "Is this legislation relevant for organizations giving credit, and "
+    "which of the following categories is it related to?\n\n"
+    + CATEGORY_DEFINITIONS
+    + 'Answer only JSON {"relevant": true or false, "category": the name '
+    "of the category}"
+)
 
 
 def classify_article_category(article_paragraphs: List[str]) -> Optional[str]:
@@ -45,143 +84,341 @@ def classify_article_category(article_paragraphs: List[str]) -> Optional[str]:
     Uses all paragraphs joined as the article text.
     Returns the category name (e.g. 'CREDIT_RISK') or None if it can't be parsed.
     """
-    article_text = "\n".join(article_paragraphs)
-
-    prompt = (
-        "Which of the following categories is this legistlation related to. "
-        "answer only the name of the category\n\n"
-        "1. CREDIT_RISK — Risk of financial loss arising when borrowers or "
-        "counterparties fail to meet their contractual obligations.\n\n"
-        "2. LIQUIDITY_RISK — Risk that the institution cannot meet cash or "
-        "collateral demands without incurring unacceptable costs or losses.\n\n"
-        "3. MARKET_RISK — Risk of loss from adverse movements in market "
-        "variables such as interest rates, currencies, or credit spreads.\n\n"
-        "4. OPERATIONAL_RISK — Risk of loss resulting from failures in internal "
-        "processes, people, systems, or from external disruptions or cyber events.\n\n"
-        "5. COMPLIANCE_RISK — Risk of legal, regulatory, or conduct breaches "
-        "leading to penalties, restrictions, or reputational harm.\n\n"
-        f"{article_text}"
+    raw = query_llm(
+        "\n".join(article_paragraphs), CATEGORY_PROMPT,
+        max_tokens=LABEL_TOKENS, stop=LABEL_STOP,
+    )
+    return parse_category(raw)
+
+
+async def classify_article_category_async(
+    client: httpx.AsyncClient, sem: asyncio.Semaphore, article_paragraphs: List[str]
+) -> Optional[str]:
+    """Async version of classify_article_category."""
+    raw = await query_llm_async(
+        client, sem, "\n".join(article_paragraphs), CATEGORY_PROMPT,
+        max_tokens=LABEL_TOKENS, stop=LABEL_STOP,
+    )
+    return parse_category(raw)
+
+
+def classify_article_combined(article_paragraphs: List[str]) -> Tuple[bool, Optional[str]]:
+    """
+    One LLM call for both questions of the pipeline: is this *article*
+    relevant for credit institutions (select_relevant), and which of the 5
+    risk categories does it belong to. Returns (relevant, category), with
+    category None if it can't be parsed.
+    """
+    raw = query_llm(
+        "\n".join(article_paragraphs), COMBINED_PROMPT, schema=COMBINED_FORMAT
+    )
+    return parse_combined(raw)
+
+
+async def classify_article_combined_async(
+    client: httpx.AsyncClient, sem: asyncio.Semaphore, article_paragraphs: List[str]
+) -> Tuple[bool, Optional[str]]:
+    """Async version of classify_article_combined."""
+    raw = await query_llm_async(
+        client, sem, "\n".join(article_paragraphs), COMBINED_PROMPT,
+        schema=COMBINED_FORMAT,
     )
+    return parse_combined(raw)
 
-    raw = query_llm(prompt)
-    ans = raw.strip().upper()
 
-    # Take the first token and strip punctuation
-    first_token = ans.split()[0].strip(" .,:;")
+def parse_combined(raw: str) -> Tuple[bool, Optional[str]]:
+    try:
+        answer = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        answer = None
+    if not isinstance(answer, dict):
+        # Like a YES/NO answer that is neither: not relevant
+        return False, None
 
-    if first_token in VALID_CATEGORIES:
-        return first_token
+    relevant = str(answer.get("relevant", "")).strip().lower() in ("true", "yes")
+    category = answer.get("category")
+    if not isinstance(category, str) or not category.strip():
+        return relevant, None
+    return relevant, parse_category(category)
 
-    # Sometimes the model might answer like "1. CREDIT_RISK"
-    # so we also look for any valid category substring
-    for cat in VALID_CATEGORIES:
-        if cat in ans:
-            return cat
+
+def parse_category(raw: str) -> Optional[str]:
+    # Usually the answer is just the name; sometimes the model answers like
+    # "1. CREDIT_RISK", so we take the first category name anywhere in it
+    m = CATEGORY_RX.search(raw.upper())
 
     # If we really can't map it, return None so we can count it
-    return None
+    return m.group(0) if m else None
 
 
 # ---------------------------------------------------------
-# 3. Main splitting logic (article-level classification)
+# 2. Main splitting logic (article-level classification)
 # ---------------------------------------------------------
 
 
-def split_credit_related_by_risk(
-    input_json: str = "credit_related_eba.json",
-    out_credit: str = "credit_risk_eba.json",
-    out_liquidity: str = "liquidity_risk_eba.json",
-    out_market: str = "market_risk_eba.json",
-    out_operational: str = "operational_risk_eba.json",
-    out_compliance: str = "compliance_risk_eba.json",
-) -> None:
-    # Load the credit-related articles (from previous step)
-    with open(input_json, "r", encoding="utf-8") as f:
-        articles: List[Dict[str, Any]] = json.load(f)
+def article_record(
+    doc_title: str, doc_name: str, article: Dict[str, Any], paragraphs: List[str]
+) -> Dict[str, Any]:
+    # The record we store is still per-article, with all paragraphs included
+    return {
+        "document title": doc_title,
+        "document name": doc_name,
+        "article id": article.get("article id"),
+        "article name": article.get("article name"),
+        "article paragraphs": paragraphs,
+    }
 
-    credit_risk: List[Dict[str, Any]] = []
-    liquidity_risk: List[Dict[str, Any]] = []
-    market_risk: List[Dict[str, Any]] = []
-    operational_risk: List[Dict[str, Any]] = []
-    compliance_risk: List[Dict[str, Any]] = []
 
-    unclassified_count = 0
-    total_articles = len(articles)
+async def write_by_category(
+    items: AsyncIterable[Tuple[Optional[Dict[str, Any]], Optional[str]]],
+    output_paths: Dict[str, str],
+) -> Dict[Optional[str], int]:
+    """
+    Writes each (record, category) as a JSON line to output_paths[category]
+    as soon as it comes. Returns the number of records per category; the
+    ones without an output (category None) are only counted, under None.
+    """
+    counts: Dict[Optional[str], int] = dict.fromkeys(output_paths, 0)
+    counts[None] = 0
 
-    print(f"Loaded {total_articles} credit-related articles\n")
+    with ExitStack() as stack:
+        files = {
+            cat: stack.enter_context(open(path, "wb"))
+            for cat, path in output_paths.items()
+        }
+
+        n = 0
+        async for record, category in items:
+            n += 1
+            if category in files:
+                files[category].write(orjson.dumps(record) + b"\n")
+                counts[category] += 1
+            else:
+                counts[None] += 1
+
+            if n % GC_EVERY == 0:
+                gc.collect()
 
-    for art_index, art in enumerate(articles, start=1):
-        doc_title = art.get("document title", "")
-        doc_name = art.get("document name", "")
-        article_id = art.get("article id")
-        article_name = art.get("article name")
-        paragraphs = art.get("article paragraphs", [])
+    return counts
 
-        print(
-            f"Processing article {art_index}/{total_articles} "
-            f"(id={article_id}, {len(paragraphs)} paragraphs)"
+
+def checked(record: Dict[str, Any], answer, progress: tqdm):
+    """
+    `answer` of a map_in_order result, or None (reported) if its request
+    failed, so the article is counted as unclassified.
+    """
+    progress.update()
+    if isinstance(answer, Exception):
+        progress.write(
+            f"  [WARN] Article {record.get('article id')} of "
+            f"{record.get('document name')} failed: {answer!r}"
         )
+        return None
+    return answer
 
-        if not paragraphs:
-            print(f"  [WARN] Article {article_id} has no paragraphs, skipping")
-            unclassified_count += 1
-            continue
-
-        category = classify_article_category(paragraphs)
-
-        # Always print classification result
-        if category is not None:
-            print(f"  Article {article_id} classified as {category}")
-        else:
-            print(f"  Article {article_id} classified as UNCLASSIFIED")
-
-        # The record we store is still per-article, with all paragraphs included
-        record = {
-            "document title": doc_title,
-            "document name": doc_name,
-            "article id": article_id,
-            "article name": article_name,
-            "article paragraphs": paragraphs,
-        }
 
-        if category == "CREDIT_RISK":
-            credit_risk.append(record)
-        elif category == "LIQUIDITY_RISK":
-            liquidity_risk.append(record)
-        elif category == "MARKET_RISK":
-            market_risk.append(record)
-        elif category == "OPERATIONAL_RISK":
-            operational_risk.append(record)
-        elif category == "COMPLIANCE_RISK":
-            compliance_risk.append(record)
-        else:
-            unclassified_count += 1
+def print_category_counts(counts: Dict[Optional[str], int]) -> None:
+    print(f"CREDIT_RISK articles: {counts['CREDIT_RISK']}")
+    print(f"LIQUIDITY_RISK articles: {counts['LIQUIDITY_RISK']}")
+    print(f"MARKET_RISK articles: {counts['MARKET_RISK']}")
+    print(f"OPERATIONAL_RISK articles: {counts['OPERATIONAL_RISK']}")
+    print(f"COMPLIANCE_RISK articles: {counts['COMPLIANCE_RISK']}")
+    print(f"Unclassified articles: {counts[None]}")
 
-    # Save outputs
-    with open(out_credit, "w", encoding="utf-8") as f:
-        json.dump(credit_risk, f, ensure_ascii=False, indent=4)
 
-    with open(out_liquidity, "w", encoding="utf-8") as f:
-        json.dump(liquidity_risk, f, ensure_ascii=False, indent=4)
+def split_credit_related_by_risk(
+    input_json: str = "credit_related_eba.jsonl",
+    out_credit: str = "credit_risk_eba.jsonl",
+    out_liquidity: str = "liquidity_risk_eba.jsonl",
+    out_market: str = "market_risk_eba.jsonl",
+    out_operational: str = "operational_risk_eba.jsonl",
+    out_compliance: str = "compliance_risk_eba.jsonl",
+) -> None:
+    """
+    Blocking wrapper around split_credit_related_by_risk_async for CLI use.
 
-    with open(out_market, "w", encoding="utf-8") as f:
-        json.dump(market_risk, f, ensure_ascii=False, indent=4)
+    The five outputs are JSONL: one article record per line, in input order,
+    written as soon as the article and the ones before it are classified, so
+    memory use doesn't grow with the output. Articles whose request failed
+    are reported and counted as unclassified.
+    """
+    asyncio.run(split_credit_related_by_risk_async(
+        input_json, out_credit, out_liquidity, out_market,
+        out_operational, out_compliance,
+    ))
+
+
+async def split_credit_related_by_risk_async(
+    input_json: str = "credit_related_eba.jsonl",
+    out_credit: str = "credit_risk_eba.jsonl",
+    out_liquidity: str = "liquidity_risk_eba.jsonl",
+    out_market: str = "market_risk_eba.jsonl",
+    out_operational: str = "operational_risk_eba.jsonl",
+    out_compliance: str = "compliance_risk_eba.jsonl",
+) -> None:
+    # Load the credit-related articles (from previous step)
+    articles: List[Dict[str, Any]] = load_articles(input_json)
+
+    output_paths = {
+        "CREDIT_RISK": out_credit,
+        "LIQUIDITY_RISK": out_liquidity,
+        "MARKET_RISK": out_market,
+        "OPERATIONAL_RISK": out_operational,
+        "COMPLIANCE_RISK": out_compliance,
+    }
+    total_articles = len(articles)
 
-    with open(out_operational, "w", encoding="utf-8") as f:
-        json.dump(operational_risk, f, ensure_ascii=False, indent=4)
+    print(f"Loaded {total_articles} credit-related articles\n")
+
+    def article_records():
+        # (article id, record), the record None for an article without paragraphs
+        for art_index in range(total_articles):
+            art = articles[art_index]
+            # Drop the article from the input list once it is queued
+            articles[art_index] = None
+            paragraphs = art.get("article paragraphs", [])
+
+            if not paragraphs:
+                yield art.get("article id"), None
+                continue
+
+            yield art.get("article id"), article_record(
+                art.get("document title", ""), art.get("document name", ""),
+                art, paragraphs,
+            )
+
+    async def category_of(item):
+        _, record = item
+        if record is None:
+            return None
+        return await classify_article_category_async(
+            client, sem, record["article paragraphs"]
+        )
 
-    with open(out_compliance, "w", encoding="utf-8") as f:
-        json.dump(compliance_risk, f, ensure_ascii=False, indent=4)
+    # The articles are classified concurrently (at most CONCURRENCY at a
+    # time), and each one is written out as soon as it and the ones before
+    # it are done, so the outputs keep the input order
+    async def classified():
+        with tqdm(total=total_articles, desc="LLM", unit="article") as progress:
+            async for (art_id, record), category in map_in_order(
+                category_of, article_records()
+            ):
+                if record is None:
+                    progress.update()
+                    progress.write(f"  [WARN] Article {art_id} has no paragraphs, skipping")
+                    yield None, None
+                    continue
+                yield record, checked(record, category, progress)
+
+    sem = asyncio.Semaphore(CONCURRENCY)
+    async with make_async_client() as client:
+        counts = await write_by_category(classified(), output_paths)
 
     print("\nDone.")
     print(f"Total articles processed: {total_articles}")
-    print(f"CREDIT_RISK articles: {len(credit_risk)}")
-    print(f"LIQUIDITY_RISK articles: {len(liquidity_risk)}")
-    print(f"MARKET_RISK articles: {len(market_risk)}")
-    print(f"OPERATIONAL_RISK articles: {len(operational_risk)}")
-    print(f"COMPLIANCE_RISK articles: {len(compliance_risk)}")
-    print(f"Unclassified articles: {unclassified_count}")
+    print_category_counts(counts)
+
+
+def split_documents_by_risk(
+    input_json: str = "eba_parsed.json",
+    out_credit: str = "credit_risk_eba.jsonl",
+    out_liquidity: str = "liquidity_risk_eba.jsonl",
+    out_market: str = "market_risk_eba.jsonl",
+    out_operational: str = "operational_risk_eba.jsonl",
+    out_compliance: str = "compliance_risk_eba.jsonl",
+    out_unrelated: str = "unrelated_eba.jsonl",
+) -> None:
+    """
+    Blocking wrapper around split_documents_by_risk_async for CLI use.
+
+    The whole pipeline in one pass over the parsed documents: each article
+    is asked for relevance and risk category in a single LLM call, instead
+    of select_relevant.py followed by split_credit_related_by_risk. The
+    outputs are JSONL, as there; articles whose request failed are reported
+    and left out of all of them.
+    """
+    asyncio.run(split_documents_by_risk_async(
+        input_json, out_credit, out_liquidity, out_market,
+        out_operational, out_compliance, out_unrelated,
+    ))
+
+
+async def split_documents_by_risk_async(
+    input_json: str = "eba_parsed.json",
+    out_credit: str = "credit_risk_eba.jsonl",
+    out_liquidity: str = "liquidity_risk_eba.jsonl",
+    out_market: str = "market_risk_eba.jsonl",
+    out_operational: str = "operational_risk_eba.jsonl",
+    out_compliance: str = "compliance_risk_eba.jsonl",
+    out_unrelated: str = "unrelated_eba.jsonl",
+) -> None:
+    # Load parsed documents (output of parse_EBA.py / parse_fiva_mok.py)
+    with open(input_json, "rb") as f:
+        documents: List[Dict[str, Any]] = orjson.loads(f.read())
+
+    output_paths = {
+        "CREDIT_RISK": out_credit,
+        "LIQUIDITY_RISK": out_liquidity,
+        "MARKET_RISK": out_market,
+        "OPERATIONAL_RISK": out_operational,
+        "COMPLIANCE_RISK": out_compliance,
+        "UNRELATED": out_unrelated,
+    }
+    total_docs = len(documents)
+
+    print(f"Total documents to process: {total_docs}\n")
+
+    total_articles = sum(
+        1
+        for doc in documents
+        for article in doc.get("articles", [])
+        if article.get("article paragraphs")
+    )
+
+    def article_records():
+        for doc_index in range(total_docs):
+            doc = documents[doc_index]
+            # Drop the document from the input list once its articles are queued
+            documents[doc_index] = None
+            for article in doc.get("articles", []):
+                paragraphs = article.get("article paragraphs", [])
+                if paragraphs:
+                    yield article_record(
+                        doc.get("document title", ""), doc.get("document name", ""),
+                        article, paragraphs,
+                    )
+
+    # Streamed to the outputs in input order, as in split_credit_related_by_risk.
+    # Articles whose request failed go to no output and are counted apart
+    failed_count = 0
+
+    async def classified():
+        nonlocal failed_count
+        with tqdm(total=total_articles, desc="LLM", unit="article") as progress:
+            async for record, answer in map_in_order(
+                lambda record: classify_article_combined_async(
+                    client, sem, record["article paragraphs"]
+                ),
+                article_records(),
+            ):
+                answer = checked(record, answer, progress)
+                if answer is None:
+                    failed_count += 1
+                    continue
+                relevant, category = answer
+                yield record, category if relevant else "UNRELATED"
+
+    sem = asyncio.Semaphore(CONCURRENCY)
+    async with make_async_client() as client:
+        counts = await write_by_category(classified(), output_paths)
+
+    print("\nDone.")
+    print(f"Total relevant: {sum(counts.values()) - counts['UNRELATED']}")
+    print(f"Total unrelated: {counts['UNRELATED']}")
+    print_category_counts(counts)
+    if failed_count:
+        print(f"Failed (in no output): {failed_count}")
 
 
 if __name__ == "__main__":
-    split_credit_related_by_risk()
+    split_documents_by_risk()